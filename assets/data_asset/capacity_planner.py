@@ -0,0 +1,387 @@
+"""
+Capacity planning for the edge application from its own metrics messages: a throughput model
+per device class, with bootstrap confidence bounds, and recommended settings.
+
+    python capacity_planner.py --recording feed-rec --target-rate 40
+    python capacity_planner.py --jsonl edge-metrics.jsonl --target-latency 0.25 --camera-rate 30
+"""
+import re
+import json
+import math
+import argparse
+import collections
+
+import numpy as np
+
+# Number of bootstrap refits behind the confidence bounds
+BOOTSTRAP_FITS = 200
+
+# Fraction of the (lower bound) capacity to plan for when no target rate is given, since a
+# stage at full utilization queues without limit
+HEADROOM = 0.9
+
+
+# The planner's view of one metrics message, or None if the window can't be used: no config
+# or latency block, nothing scored, or a DigitPredictor (re)started in it (load and warm-up
+# distort the window).  As the testing-kafka notebook works out by hand, but ti is taken from
+# the rate of images that left the source, shed ones included:
+#   ti = 1 / submitted rate - delay * (frame_skip + 1) - prep mean
+#   tq = classify_parallel / scored rate - predict mean
+def observation(message):
+    config = message.get('config')
+    latency = message.get('latency_metrics')
+    if config is None or latency is None or latency.get('prep') is None or message.get('startup'):
+        return None
+    scored = 0
+    submitted = 0
+    for counts in message['camera_metrics'].values():
+        scored += sum(counts['certain']) + sum(counts['uncertain'])
+        # Frames skipped or dropped by the camera never left the source
+        submitted += sum(n for stage, n in counts.get('shed', {}).items() if stage not in ('source', 'dropped'))
+    submitted += scored
+    duration = float(config['metrics_duration'])
+    if scored == 0 or duration <= 0:
+        return None
+    rate = scored / duration
+    offered_rate = submitted / duration
+    parallelism = int(config['classify_parallel'])
+    delay = float(config['delay'] or 0.0)
+    frame_skip = int(config.get('frame_skip') or 0)
+    prep = latency['prep']['mean']
+    predict = latency['predict']['mean']
+    return {'parallelism': parallelism,
+            'delay': delay,
+            'frame_skip': frame_skip,
+            'rate': rate,
+            'offered_rate': offered_rate,
+            'prep': prep,
+            'predict': predict,
+            'ti': 1.0 / offered_rate - delay * (frame_skip + 1) - prep,
+            'tq': parallelism / rate - predict,
+            'images': scored}
+
+
+# Weighted least squares fit of y = a + b * (p - 1); b is 0 when only one p was seen
+def _fit_linear(p, y, w):
+    if len(np.unique(p)) < 2:
+        return float(np.average(y, weights=w)), 0.0
+    sw = np.sqrt(w)
+    (a, b), residuals, rank, sv = np.linalg.lstsq(np.stack([sw, sw * (p - 1)], axis=1), sw * y, rcond=None)
+    return float(a), float(b)
+
+
+class ThroughputModel(object):
+    """Fitted two-stage model of one device class: the source and ImagePrep take
+    delay + prep + ti per image, and each of p scoring channels predict(p) + tq(p), linear in p
+    as channels contend for the device's cores.  The rate is that of the slower stage.
+
+    Args:
+        prep: mean ImagePrep time per image.
+        ti: ingest overhead per image.
+        predict: (a, b) of predict(p) = a + b * (p - 1).
+        tq: (c, e) of tq(p) = c + e * (p - 1).
+        bound: how many windows were source- and scoring-bound.
+    """
+    def __init__(self, prep, ti, predict, tq, bound):
+        self.prep = prep
+        self.ti = ti
+        self.predict = predict
+        self.tq = tq
+        self.bound = bound
+
+    @classmethod
+    def fit(cls, observations, iterations=5):
+        p = np.array([o['parallelism'] for o in observations], dtype=np.float64)
+        w = np.array([o['images'] for o in observations], dtype=np.float64)
+        values = {key: np.array([o[key] for o in observations], dtype=np.float64)
+                  for key in ('delay', 'frame_skip', 'rate', 'prep', 'predict', 'ti', 'tq')}
+        prep = float(np.average(values['prep'], weights=w))
+        predict = _fit_linear(p, values['predict'], w)
+        # A window only shows the overhead of the stage that held it back, so ti is fit from the
+        # source-bound windows and tq from the scoring-bound ones, until the split is stable
+        source_bound = np.ones(len(p), dtype=bool)
+        for i in range(iterations):
+            source = source_bound if source_bound.any() else np.ones(len(p), dtype=bool)
+            scoring = ~source_bound if (~source_bound).any() else np.ones(len(p), dtype=bool)
+            ti = max(0.0, float(np.average(values['ti'][source], weights=w[source])))
+            tq = _fit_linear(p[scoring], values['tq'][scoring], w[scoring])
+            model = cls(prep, ti, predict, tq, None)
+            # Which stage the model says held each window back
+            updated = model.source_time(values['delay'], values['frame_skip']) >= model.service_time(p) / p
+            if (updated == source_bound).all() and i > 0:
+                break
+            source_bound = updated
+        model.bound = {'source': int(source_bound.sum()), 'scoring': int((~source_bound).sum())}
+        return model
+
+    def service_time(self, parallelism):
+        """Time a scoring channel spends per image at this parallelism."""
+        p = np.asarray(parallelism, dtype=np.float64)
+        return np.maximum(self.predict[0] + self.predict[1] * (p - 1) + self.tq[0] + self.tq[1] * (p - 1), 1e-9)
+
+    def source_time(self, delay, frame_skip=0):
+        # ImageSource sleeps delay for skipped frames too
+        return np.asarray(delay, dtype=np.float64) * (frame_skip + 1) + self.prep + self.ti
+
+    def rate(self, parallelism, delay=0.0, frame_skip=0):
+        """Predicted images/sec."""
+        return np.minimum(1.0 / self.source_time(delay, frame_skip), parallelism / self.service_time(parallelism))
+
+    def latency(self, parallelism, rate):
+        """Predicted mean seconds from enrichment to scored, at an offered rate, inf if over capacity.
+
+        Waiting in front of the parallel region uses the heavy-traffic M/D/c approximation
+        service * utilization / (2 * p * (1 - utilization)).
+        """
+        service = self.service_time(parallelism)
+        utilization = rate * service / parallelism
+        if utilization >= 1.0:
+            return float('inf')
+        return float(self.prep + service + service * utilization / (2 * parallelism * (1 - utilization)))
+
+    def describe(self):
+        return {'prep': self.prep, 'ti': self.ti, 'predict': list(self.predict), 'tq': list(self.tq), 'bound': self.bound}
+
+
+class CapacityPlanner(object):
+    """Collects metrics messages per device class, fits a ThroughputModel for each and
+    recommends settings.
+
+    Args:
+        class_pattern: regular expression applied to each camera name; its first group is
+            the device class (e.g. r'^[^-]+-(.+?)(?:-v\\d+)?$' for the hostname).  Without
+            one, each job (the set of cameras in its metrics messages) is its own class.
+        max_parallelism: largest parallelism considered.
+        confidence: width of the confidence intervals.
+        seed: for the bootstrap, so plans are repeatable.
+    """
+    def __init__(self, class_pattern=None, max_parallelism=8, confidence=0.9, seed=0):
+        self.class_pattern = re.compile(class_pattern) if class_pattern else None
+        self.max_parallelism = max_parallelism
+        self.confidence = confidence
+        self.seed = seed
+        self.observations = collections.defaultdict(list)
+        self.skipped = 0
+
+    def device_class(self, message):
+        cameras = sorted(message.get('camera_metrics', {}))
+        if self.class_pattern is None:
+            return ",".join(cameras)
+        classes = set()
+        for camera in cameras:
+            match = self.class_pattern.search(camera)
+            classes.add(match.group(1) if match is not None else camera)
+        return ",".join(sorted(classes))
+
+    def add(self, message):
+        """Take one metrics message (other messages are ignored)."""
+        if 'camera_metrics' not in message:
+            return
+        obs = observation(message)
+        if obs is None:
+            self.skipped += 1
+            return
+        self.observations[self.device_class(message)].append(obs)
+
+    def extend(self, messages):
+        for message in messages:
+            self.add(message)
+
+    def _bootstrap(self, observations):
+        rng = np.random.RandomState(self.seed)
+        models = []
+        for i in range(BOOTSTRAP_FITS):
+            sample = [observations[j] for j in rng.randint(0, len(observations), size=len(observations))]
+            models.append(ThroughputModel.fit(sample))
+        return models
+
+    def _bounds(self, values):
+        # Nearest-rank percentiles, so inf values (over capacity) sort last rather than turning
+        # the interpolation into NaN; a bound that lands on one is None
+        values = np.sort(np.asarray(values, dtype=np.float64))
+        tail = (1.0 - self.confidence) / 2
+        bounds = (values[int(math.floor(tail * (len(values) - 1)))], values[int(math.ceil((1.0 - tail) * (len(values) - 1)))])
+        return tuple(float(v) if np.isfinite(v) else None for v in bounds)
+
+    def _pace(self, models, p, rate, frame_skip, upper):
+        # The delay at which the bootstrap bound of the rate is rate: the largest delay whose lower
+        # bound still reaches it, or (upper) the smallest whose upper bound does not exceed it.
+        # At delay 1/rate no model goes faster than rate, so only the lower bound can miss it.
+        lo, hi = 0.0, 1.0 / rate
+        for i in range(40):
+            mid = (lo + hi) / 2
+            bounds = self._bounds([m.rate(p, mid, frame_skip) for m in models])
+            if (bounds[1] > rate) if upper else (bounds[0] >= rate):
+                lo = mid
+            else:
+                hi = mid
+        return hi if upper else lo
+
+    def plan(self, target_rate=None, target_latency=None, camera_rate=None):
+        """Recommend settings for every device class.
+
+        Args:
+            target_rate: images/sec to sustain; the smallest parallelism whose lower bound
+                reaches it is picked, and delay is set so the lower bound of the source's
+                rate still reaches it.
+            target_latency: seconds from enrichment to scored; the parallelism with the
+                highest rate whose upper-bound latency meets it is picked, and max_age is
+                set to it so late images are shed rather than scored late.
+            camera_rate: frames/sec a real camera produces (delay is then fixed by the
+                camera); frame_skip is set to bring it within the recommended rate.
+
+        Otherwise delay keeps the upper bound of the source's rate within the recommended rate.
+        'saturated' is the fraction of bootstrap models over capacity at that rate.
+
+        Returns:
+            dict of device class -> plan (model, per-parallelism predictions and recommendation).
+        """
+        plans = {}
+        for device, observations in sorted(self.observations.items()):
+            model = ThroughputModel.fit(observations)
+            models = self._bootstrap(observations)
+            parallelisms = list(range(1, self.max_parallelism + 1))
+
+            predictions = []
+            for p in parallelisms:
+                capacity = self._bounds([m.rate(p) for m in models])
+                predictions.append({'parallelism': p,
+                                    'rate': float(model.rate(p)),
+                                    'rate_bounds': capacity,
+                                    'service_time': float(model.service_time(p))})
+
+            recommended = None
+            notes = []
+            if target_latency is not None:
+                # Highest rate each parallelism can take while the upper-bound latency meets the target
+                best = None
+                for prediction in predictions:
+                    p = prediction['parallelism']
+                    lo, hi = 0.0, prediction['rate_bounds'][0]
+                    for i in range(40):
+                        mid = (lo + hi) / 2
+                        latency = self._bounds([m.latency(p, mid) for m in models])[1]
+                        if latency is not None and latency <= target_latency:
+                            lo = mid
+                        else:
+                            hi = mid
+                    if target_rate is not None and lo < target_rate:
+                        continue
+                    # Prefer the smaller parallelism unless a larger one is clearly faster
+                    if best is None or lo > best[1] * 1.05:
+                        best = (p, lo)
+                if best is not None and best[1] > 0:
+                    recommended = {'parallelism': best[0], 'rate': target_rate if target_rate is not None else best[1]}
+                else:
+                    notes.append("no parallelism up to %d meets the latency target" % self.max_parallelism)
+            elif target_rate is not None:
+                for prediction in predictions:
+                    if prediction['rate_bounds'][0] >= target_rate:
+                        recommended = {'parallelism': prediction['parallelism'], 'rate': target_rate}
+                        break
+                if recommended is None:
+                    notes.append("no parallelism up to %d reaches %.1f images/sec" % (self.max_parallelism, target_rate))
+            else:
+                # As fast as the device goes: the smallest parallelism within 5% of the best lower bound
+                top = max(prediction['rate_bounds'][0] for prediction in predictions)
+                prediction = next(prediction for prediction in predictions if prediction['rate_bounds'][0] >= 0.95 * top)
+                recommended = {'parallelism': prediction['parallelism'], 'rate': HEADROOM * prediction['rate_bounds'][0]}
+
+            if recommended is not None:
+                p = recommended['parallelism']
+                rate = recommended['rate']
+                if camera_rate is not None:
+                    # The camera sets the pace; skip frames to bring it within the rate
+                    recommended['delay'] = 1.0 / camera_rate
+                    recommended['frame_skip'] = max(0, int(math.ceil(camera_rate / rate - 1e-9)) - 1)
+                else:
+                    # The source's own per-image time, plus the delay, paces it at the rate
+                    recommended['delay'] = self._pace(models, p, rate, 0, target_rate is None)
+                    recommended['frame_skip'] = 0
+                delay, frame_skip = recommended['delay'], recommended['frame_skip']
+                recommended['rate'] = float(model.rate(p, delay, frame_skip))
+                recommended['rate_bounds'] = self._bounds([m.rate(p, delay, frame_skip) for m in models])
+                # Every model at the one expected rate; the ones it overloads count as saturated
+                latencies = [m.latency(p, recommended['rate']) for m in models]
+                latency = model.latency(p, recommended['rate'])
+                recommended['latency'] = latency if math.isfinite(latency) else None
+                recommended['latency_bounds'] = self._bounds(latencies)
+                recommended['saturated'] = float(np.mean([not math.isfinite(l) for l in latencies]))
+                if target_latency is not None:
+                    recommended['max_age'] = target_latency
+                if target_rate is not None and recommended['rate_bounds'][0] < target_rate * (1 - 1e-6):
+                    notes.append("the expected rate's lower bound, %.1f images/sec, is under the target" % recommended['rate_bounds'][0])
+                if recommended['saturated'] > 0:
+                    notes.append("%.0f%% of the bootstrap models are over capacity at %.1f images/sec" % (
+                                 100.0 * recommended['saturated'], recommended['rate']))
+                if model.bound['scoring'] == 0:
+                    notes.append("every window was source-bound, scoring capacity is extrapolated from predict times")
+                if len(set(o['parallelism'] for o in observations)) < 2:
+                    notes.append("only parallelism %d was observed, contention between channels is not modelled" % observations[0]['parallelism'])
+
+            plans[device] = {'windows': len(observations),
+                             'model': model.describe(),
+                             'predictions': predictions,
+                             'recommended': recommended,
+                             'notes': notes}
+        return plans
+
+
+def metrics_from_recording(path):
+    import feed_recording
+    recording = feed_recording.FeedRecording(path)
+    for row in recording.rows(kinds=['metrics']):
+        yield recording.message(row)
+
+
+def metrics_from_jsonl(path):
+    # e.g. the edge_runner file:edge-{kind}.jsonl sink output
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def print_plan(plans):
+    for device, plan in plans.items():
+        model = plan['model']
+        print("Device class %s (%d windows, %d source-bound, %d scoring-bound)" % (
+              device, plan['windows'], model['bound']['source'], model['bound']['scoring']))
+        print("  prep %.4fs  ti %.4fs  predict %.4fs%+.4fs/channel  tq %.4fs%+.4fs/channel" % (
+              model['prep'], model['ti'], model['predict'][0], model['predict'][1], model['tq'][0], model['tq'][1]))
+        for prediction in plan['predictions']:
+            print("  parallelism %2d: %8.1f img/s  (%.1f - %.1f)" % ((prediction['parallelism'], prediction['rate']) + prediction['rate_bounds']))
+        recommended = plan['recommended']
+        if recommended is not None:
+            print("  Recommended: parallelism=%d delay=%.4f frame_skip=%d%s" % (
+                  recommended['parallelism'], recommended['delay'], recommended['frame_skip'],
+                  " max_age=%.3f" % recommended['max_age'] if 'max_age' in recommended else ""))
+            print("    expected %.1f - %.1f img/s, latency %s - %s" % (recommended['rate_bounds'] + tuple(
+                  "%.4fs" % latency if latency is not None else "inf" for latency in recommended['latency_bounds'])))
+        for note in plan['notes']:
+            print("  Note:", note)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Recommend edge settings from recorded metrics messages")
+    parser.add_argument('--recording', action='append', default=[], help="feed_recording directory")
+    parser.add_argument('--jsonl', action='append', default=[], help="file of metrics messages, one JSON per line")
+    parser.add_argument('--target-rate', type=float, default=None, help="images/sec to sustain")
+    parser.add_argument('--target-latency', type=float, default=None, help="seconds from enrichment to scored")
+    parser.add_argument('--camera-rate', type=float, default=None, help="frames/sec of a real camera")
+    parser.add_argument('--class-pattern', default=None, help="regex whose first group is a camera's device class")
+    parser.add_argument('--max-parallelism', type=int, default=8)
+    parser.add_argument('--confidence', type=float, default=0.9)
+    parser.add_argument('--json', action='store_true', help="print the plans as JSON")
+    args = parser.parse_args()
+
+    planner = CapacityPlanner(args.class_pattern, max_parallelism=args.max_parallelism, confidence=args.confidence)
+    for path in args.recording:
+        planner.extend(metrics_from_recording(path))
+    for path in args.jsonl:
+        planner.extend(metrics_from_jsonl(path))
+    plans = planner.plan(target_rate=args.target_rate, target_latency=args.target_latency, camera_rate=args.camera_rate)
+    if args.json:
+        print(json.dumps(plans, indent=2))
+    else:
+        print_plan(plans)
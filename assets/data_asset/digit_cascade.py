@@ -0,0 +1,149 @@
+"""
+Cheap first stage for a two-stage (cascade) digit classifier: when its top probability
+reaches the threshold its answer is used, otherwise DigitPredictor falls through to the full model.
+
+    python digit_cascade.py HandwrittenDigits_Model HandwrittenDigits_FirstStage --max-loss 0.002
+"""
+import os
+import time
+import argparse
+
+import numpy as np
+
+import lazy_import
+import mnist_index_files
+
+joblib = lazy_import.lazy_module('joblib')
+
+
+# Average each factor x factor block of the (N, 28, 28) images, giving (N, (28/factor)^2) features
+# scaled to 0-1.
+def downsample(images, factor=2):
+    images = np.asarray(images, dtype=np.float32).reshape(-1, 28, 28)
+    n, h, w = images.shape
+    blocks = images.reshape(n, h // factor, factor, w // factor, factor).mean(axis=(2, 4))
+    return blocks.reshape(n, -1) / 255.0
+
+
+class LinearStage(object):
+    """Multinomial linear classifier on downsampled pixels, evaluated with numpy only.
+
+    Args:
+        coef: (10, features) weights.
+        intercept: (10,) biases.
+        factor: downsampling factor the weights were trained with.
+        threshold: minimum top probability for the stage to answer on its own.
+    """
+    def __init__(self, coef, intercept, factor=2, threshold=1.0):
+        self.coef = np.asarray(coef, dtype=np.float32)
+        self.intercept = np.asarray(intercept, dtype=np.float32)
+        self.factor = factor
+        self.threshold = threshold
+
+    @classmethod
+    def from_estimator(cls, clf, factor=2, threshold=1.0):
+        return cls(clf.coef_, clf.intercept_, factor=factor, threshold=threshold)
+
+    def predict_proba(self, images):
+        scores = downsample(images, self.factor) @ self.coef.T + self.intercept
+        scores -= scores.max(axis=1, keepdims=True)
+        np.exp(scores, out=scores)
+        scores /= scores.sum(axis=1, keepdims=True)
+        return scores
+
+    def save(self, path):
+        joblib.dump({'coef': self.coef, 'intercept': self.intercept, 'factor': self.factor, 'threshold': self.threshold}, path)
+
+    @classmethod
+    def load(cls, path):
+        return cls(**joblib.load(path))
+
+
+# Choose the lowest threshold (so the most images exit early) whose cascade accuracy stays within
+# max_loss of the full model.  Works over all candidate thresholds at once: sorting by stage-1
+# confidence, accepting the top k from stage 1 gives
+#   correct(k) = stage1_correct[:k].sum() + full_correct[k:].sum()
+def pick_threshold(confidence, stage1_correct, full_correct, max_loss):
+    order = np.argsort(-confidence, kind='stable')
+    confidence = confidence[order]
+    stage1_cum = np.concatenate([[0], np.cumsum(stage1_correct[order])])
+    full_cum = np.concatenate([[0], np.cumsum(full_correct[order])])
+    correct = stage1_cum + (full_cum[-1] - full_cum)
+    loss = (full_cum[-1] - correct) / len(confidence)
+    # Only cut between distinct confidence values, since the runtime test is confidence >= threshold
+    cuts = np.concatenate([confidence[1:] < confidence[:-1], [True]])
+    ok = np.nonzero((loss[1:] <= max_loss) & cuts)[0]
+    if len(ok) == 0:
+        return 1.0 + 1e-6, 0.0, 0.0
+    k = ok[-1] + 1
+    return float(confidence[k - 1]), k / len(confidence), float(loss[k])
+
+
+def build_first_stage(full_model_path, output_path, data_dir='.', max_loss=0.002, factor=2, chunk_size=2000, validation_size=10000):
+    """Train the first stage on all but the last validation_size train images, pick the lowest
+    threshold whose cascade loss on those stays within max_loss, and save it to output_path.
+    The reported exit rate, loss and accuracies are measured on t10k, which took no part in the choice.
+
+    Returns:
+        dict with the chosen threshold, early-exit rate, accuracies and per-image predict latencies.
+    """
+    def load(images_fn, labels_fn):
+        return (mnist_index_files.read_idx_file(os.path.join(data_dir, images_fn)),
+                mnist_index_files.read_idx_file(os.path.join(data_dir, labels_fn)))
+    train_images, train_labels = load(mnist_index_files.FN_TRAIN_IMAGES, mnist_index_files.FN_TRAIN_LABELS)
+    test_images, test_labels = load(mnist_index_files.FN_TEST_IMAGES, mnist_index_files.FN_TEST_LABELS)
+
+    split = len(train_images) - validation_size
+    valid_images, valid_labels = train_images[split:], train_labels[split:]
+
+    from sklearn.linear_model import LogisticRegression
+    clf = LogisticRegression(multi_class='multinomial', solver='lbfgs', max_iter=200)
+    clf.fit(downsample(train_images[:split], factor), train_labels[:split])
+    stage = LinearStage.from_estimator(clf, factor=factor)
+    full = joblib.load(full_model_path)
+
+    def full_predict(images):
+        return np.concatenate([full.predict(images[start:start + chunk_size].reshape(-1, 28 * 28))
+                               for start in range(0, len(images), chunk_size)])
+
+    valid_proba = stage.predict_proba(valid_images)
+    stage.threshold, valid_exit_rate, valid_loss = pick_threshold(
+        valid_proba.max(axis=1), valid_proba.argmax(axis=1) == valid_labels, full_predict(valid_images) == valid_labels, max_loss)
+
+    start_time = time.monotonic()
+    stage_proba = stage.predict_proba(test_images)
+    stage_time = (time.monotonic() - start_time) / len(test_images)
+
+    start_time = time.monotonic()
+    full_predicted = full_predict(test_images)
+    full_time = (time.monotonic() - start_time) / len(test_images)
+
+    stage_correct = stage_proba.argmax(axis=1) == test_labels
+    full_correct = full_predicted == test_labels
+    early = stage_proba.max(axis=1) >= stage.threshold
+    cascade_correct = np.where(early, stage_correct, full_correct)
+    stage.save(output_path)
+    return {'threshold': stage.threshold,
+            'early_exit_rate': float(early.mean()),
+            'accuracy_loss': float(full_correct.mean() - cascade_correct.mean()),
+            'validation_exit_rate': valid_exit_rate,
+            'validation_loss': valid_loss,
+            'stage1_accuracy': float(stage_correct.mean()),
+            'full_accuracy': float(full_correct.mean()),
+            'stage1_time': stage_time,
+            'full_time': full_time}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Train the cascade first stage and pick its threshold")
+    parser.add_argument('full_model', help="path of the full model (e.g. HandwrittenDigits_Model)")
+    parser.add_argument('output', help="where to write the first stage")
+    parser.add_argument('--data-dir', default='.', help="directory the data/mnist IDX files are under")
+    parser.add_argument('--max-loss', type=float, default=0.002, help="accepted accuracy loss against the full model, on the validation split")
+    parser.add_argument('--factor', type=int, default=2, help="downsampling factor (must divide 28)")
+    parser.add_argument('--validation-size', type=int, default=10000, help="train images held out to pick the threshold on")
+    args = parser.parse_args()
+    result = build_first_stage(args.full_model, args.output, data_dir=args.data_dir, max_loss=args.max_loss, factor=args.factor,
+                               validation_size=args.validation_size)
+    for key, value in result.items():
+        print("%-20s %s" % (key, value))
@@ -0,0 +1,148 @@
+"""
+Near-duplicate grouping of uncertain predictions at the metro, by a 64-bit perceptual hash of
+the prepared image, so the dashboards show one representative per cluster with its count.
+"""
+import numpy as np
+
+import uncertain_store
+
+IMAGE_SIZE = 28
+HASH_SIZE = 8
+
+
+# Orthonormal DCT-II basis, restricted to the lowest HASH_SIZE frequencies
+def _dct_basis(n=IMAGE_SIZE, k=HASH_SIZE):
+    x = np.arange(n)
+    basis = np.cos(np.pi * (2 * x[None, :] + 1) * np.arange(k)[:, None] / (2 * n)) * np.sqrt(2.0 / n)
+    basis[0] /= np.sqrt(2.0)
+    return basis
+
+_DCT = _dct_basis()
+_BITS = 1 << np.arange(HASH_SIZE * HASH_SIZE, dtype=np.uint64)
+
+
+# Perceptual hash of a prepared image: the signs of its 8x8 lowest DCT frequencies relative
+# to their median, packed into a 64-bit int.  Small shifts, stroke width and intensity
+# changes move only a few bits.
+def phash(prepared_image):
+    image = np.asarray(prepared_image, dtype=np.float32).reshape(IMAGE_SIZE, IMAGE_SIZE)
+    low = (_DCT @ image @ _DCT.T).reshape(-1)
+    bits = low > np.median(low[1:])
+    return int(_BITS[bits].sum())
+
+
+def hamming(a, b):
+    return bin(a ^ b).count('1')
+
+
+class BKTree(object):
+    """Burkhard-Keller tree over Hamming distance, mapping hashes to values."""
+    def __init__(self):
+        self._root = None
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def add(self, key, value):
+        node = [key, value, {}]
+        self._size += 1
+        if self._root is None:
+            self._root = node
+            return
+        current = self._root
+        while True:
+            distance = hamming(key, current[0])
+            child = current[2].get(distance)
+            if child is None:
+                current[2][distance] = node
+                return
+            current = child
+
+    def nearest(self, key, radius):
+        """The (distance, key, value) closest to key within radius, or None."""
+        best = None
+        stack = [self._root] if self._root is not None else []
+        while stack:
+            node = stack.pop()
+            distance = hamming(key, node[0])
+            if distance <= radius and (best is None or distance < best[0]):
+                best = (distance, node[0], node[1])
+            # Triangle inequality: only subtrees at distance d from this node can hold
+            # keys within radius of the query.
+            for d, child in node[2].items():
+                if distance - radius <= d <= distance + radius:
+                    stack.append(child)
+        return best
+
+
+class DuplicateIndex(object):
+    """Groups uncertain predictions into clusters of near-identical prepared images.
+
+    Args:
+        radius: maximum Hamming distance (of 64 bits) to a cluster's representative.
+        max_members: member images kept per cluster for retraining; the count keeps going past it.
+
+    A cluster is represented by its first tuple, with 'cluster_id', 'cluster_count' and
+    'cluster_images' (the members' prepared images, (N, 784) uint8) added; one added by store
+    row keeps just 'cluster_row' and page() fetches the rest.
+    """
+    def __init__(self, radius=3, max_members=1000):
+        self.radius = radius
+        self.max_members = max_members
+        self._tree = BKTree()
+        self._buffers = []
+        self.clusters = []
+        self.received = 0
+
+    def add(self, tup, row=None):
+        """Place a tuple in its cluster, returning (representative tuple, True if it started a new cluster)."""
+        self.received += 1
+        key = phash(tup['prepared_image'])
+        match = self._tree.nearest(key, self.radius)
+        image = np.asarray(tup['prepared_image'], dtype=np.uint8).reshape(1, -1)
+        if match is not None:
+            representative = self.clusters[match[2]]
+            representative['cluster_count'] += 1
+            members = len(representative['cluster_images'])
+            if members < self.max_members:
+                # Member images go in a buffer that doubles (up to max_members) when full, so
+                # adding is amortized constant time; cluster_images is a view of its filled rows
+                buffer = self._buffers[match[2]]
+                if members == len(buffer):
+                    buffer = self._buffers[match[2]] = np.concatenate([buffer, np.empty_like(buffer[:min(members, self.max_members - members)])])
+                buffer[members] = image
+                representative['cluster_images'] = buffer[:members + 1]
+            return representative, False
+        representative = dict(tup) if row is None else {'cluster_row': row}
+        representative['cluster_id'] = len(self.clusters)
+        representative['cluster_count'] = 1
+        self._buffers.append(image)
+        representative['cluster_images'] = image
+        self.clusters.append(representative)
+        self._tree.add(key, representative['cluster_id'])
+        return representative, True
+
+    def extend(self, tuples):
+        for tup in tuples:
+            self.add(tup)
+
+    def extend_store(self, page, count=None):
+        """Add the first count tuples of an uncertain_store.StorePage by store row, a page at a time."""
+        for idx in range(len(page) if count is None else min(count, len(page))):
+            self.add(page[idx], row=page.rows[idx])
+
+    def __len__(self):
+        return len(self.clusters)
+
+    def representatives(self, min_count=1, largest_first=True):
+        """Cluster representatives, for CorrectionDashboard.render_review()."""
+        selected = [c for c in self.clusters if c['cluster_count'] >= min_count]
+        if largest_first:
+            selected.sort(key=lambda c: -c['cluster_count'])
+        return selected
+
+    def page(self, store, page_size=20, min_count=1, largest_first=True):
+        """The representatives of clusters added by store row, as an uncertain_store.StorePage."""
+        selected = self.representatives(min_count, largest_first)
+        return uncertain_store.StorePage(store, [c['cluster_row'] for c in selected], page_size, extra=selected)
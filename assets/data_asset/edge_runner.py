@@ -0,0 +1,413 @@
+"""
+Standalone, multi-process version of the EdgeCameraClassifier application, without the Streams runtime:
+
+    ImageSource+Enricher -> [ring] -> ImagePrep x N -> [ring] -> DigitPredictor x M -> [ring] -> metrics/sink
+
+    python edge_runner.py --app-dir /path/to/bundle --model etc/HandwrittenDigits_Model \\
+        --source etc/mnist-test-images --prep-workers 1 --predict-workers 2 --sink file:/tmp/edge-{kind}.jsonl
+"""
+import json
+import time
+import queue
+import pickle
+import signal
+import argparse
+import multiprocessing
+
+from image_source import ImageSource, Enricher
+from image_classifier import DigitPredictor, ImagePrep, compute_metrics, message_key, simplify_classification, shed_record, is_uncertain
+import operator_profiler
+
+
+class SlotOverflow(ValueError):
+    pass
+
+
+class SlotRing(object):
+    """Bounded multi-producer/multi-consumer queue over shared memory.
+
+    Args:
+        slots: number of slots; producers block once all are in use (backpressure).
+        slot_size: maximum pickled size of one item, in bytes.
+        ctx: multiprocessing context the ring's shared memory and semaphores come from.
+    """
+    def __init__(self, slots=64, slot_size=16384, ctx=multiprocessing):
+        self.slots = slots
+        self.slot_size = slot_size
+        self._buffer = ctx.RawArray('B', slots * slot_size)
+        self._lengths = ctx.RawArray('i', slots)
+        self._head = ctx.RawValue('q', 0)
+        self._tail = ctx.RawValue('q', 0)
+        self._put_lock = ctx.Lock()
+        self._get_lock = ctx.Lock()
+        self._free = ctx.Semaphore(slots)
+        self._filled = ctx.Semaphore(0)
+        self._view = None
+
+    def _memory(self):
+        if self._view is None:
+            self._view = memoryview(self._buffer).cast('B')
+        return self._view
+
+    def _acquire(self, semaphore, stop, timeout):
+        # Wait for the semaphore, but give up if asked to stop (or after timeout, if given)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while not semaphore.acquire(timeout=0.1):
+            if stop is not None and stop.is_set():
+                return False
+            if deadline is not None and time.monotonic() > deadline:
+                return False
+        return True
+
+    def put(self, item, stop=None, timeout=None):
+        """Copy item into the next free slot, returning False if stopped before one was free."""
+        data = pickle.dumps(item, protocol=pickle.HIGHEST_PROTOCOL)
+        if len(data) > self.slot_size:
+            raise SlotOverflow("Item of %d bytes does not fit a %d byte slot" % (len(data), self.slot_size))
+        if not self._acquire(self._free, stop, timeout):
+            return False
+        # filled is only released once the slot is completely copied, so a consumer never
+        # sees a half-written slot
+        with self._put_lock:
+            slot = self._head.value % self.slots
+            offset = slot * self.slot_size
+            self._memory()[offset:offset + len(data)] = data
+            self._lengths[slot] = len(data)
+            self._head.value += 1
+        self._filled.release()
+        return True
+
+    def get(self, stop=None, timeout=None):
+        """Take the oldest item, raising queue.Empty if stopped or timed out first."""
+        if not self._acquire(self._filled, stop, timeout):
+            raise queue.Empty
+        with self._get_lock:
+            slot = self._tail.value % self.slots
+            offset = slot * self.slot_size
+            data = bytes(self._memory()[offset:offset + self._lengths[slot]])
+            self._tail.value += 1
+        self._free.release()
+        return pickle.loads(data)
+
+    def __len__(self):
+        return self._head.value - self._tail.value
+
+
+##
+## Sinks: where the uncertain images and metrics messages go
+##
+class MemorySink(object):
+    """In-memory stand-in for Event Streams; messages can be drained from the parent process."""
+    def __init__(self, ctx=multiprocessing):
+        # A manager queue, since a plain multiprocessing.Queue would keep the sink process from
+        # exiting until the parent drained it, and the parent only drains after joining.
+        self._manager = ctx.Manager()
+        self.messages = self._manager.Queue()
+
+    def open(self):
+        pass
+
+    def publish(self, message, kind):
+        self.messages.put((kind, message))
+
+    def drain(self):
+        drained = []
+        while True:
+            try:
+                drained.append(self.messages.get(timeout=0.1))
+            except queue.Empty:
+                return drained
+
+    def close(self):
+        pass
+
+
+class FileSink(object):
+    """Appends each message to a file as one JSON line, like the messages on the topic.
+
+    A '{kind}' in the path splits the 'metrics' and 'images' channels into separate files.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._files = {}
+
+    def open(self):
+        pass
+
+    def publish(self, message, kind):
+        path = self.path.format(kind=kind)
+        if path not in self._files:
+            self._files[path] = open(path, 'a')
+        self._files[path].write(json.dumps(message) + '\n')
+        self._files[path].flush()
+
+    def close(self):
+        for f in self._files.values():
+            f.close()
+
+
+class EventStreamsSink(object):
+    """Publishes to the Event Streams metrics and images topics, keyed by camera, with the same
+    credentials JSON the notebooks use.
+    """
+    def __init__(self, metrics_topic, images_topic, credentials):
+        self.topics = {'metrics': metrics_topic, 'images': images_topic}
+        self.credentials = credentials
+        self._producer = None
+
+    def open(self):
+        import ssl
+        import kafka
+        self._producer = kafka.KafkaProducer(bootstrap_servers=self.credentials["kafka_brokers_sasl"],
+                                             security_protocol="SASL_SSL",
+                                             sasl_mechanism="PLAIN",
+                                             sasl_plain_username=self.credentials["user"],
+                                             sasl_plain_password=self.credentials["api_key"],
+                                             ssl_cafile=ssl.get_default_verify_paths().cafile)
+
+    def publish(self, message, kind):
+        self._producer.send(self.topics[kind], json.dumps(message).encode('utf-8'), key=message_key(message).encode('utf-8'))
+
+    def close(self):
+        if self._producer is not None:
+            self._producer.flush()
+            self._producer.close()
+
+
+##
+## Stage processes
+##
+def _put(ring_out, t, stop):
+    # A tuple too big for a slot (e.g. a large frame) is shed and counted rather than ending the stage
+    try:
+        return ring_out.put(t, stop=stop)
+    except SlotOverflow:
+        return ring_out.put(shed_record(t, 'oversize', time.time() - t['enrich_time']), stop=stop)
+
+
+def _send_end(ring_out, stop, downstream_workers):
+    # After a shutdown request the downstream workers may already be gone, so don't wait forever on a full ring
+    for i in range(downstream_workers):
+        ring_out.put(None, timeout=1.0 if stop.is_set() else None)
+
+
+def _finish(done, ring_out, stop, downstream_workers):
+    # The last worker of a stage to finish passes end-of-input on to every downstream worker
+    with done.get_lock():
+        done.value -= 1
+        last = done.value == 0
+    if last:
+        _send_end(ring_out, stop, downstream_workers)
+
+
+def _source_process(config, ring_out, stop, downstream_workers):
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    source = ImageSource(lambda: config['source_type'], config['sources'],
+                         delay=lambda: config['delay'], repeat=lambda: config['repeat'], app_dir=config['app_dir'],
+                         frame_skip=config['frame_skip'], cameras=config['cameras'],
+                         profile_rate=config['profile_rate'], profile_dir=config['profile_dir'])
+    enricher = Enricher(lambda: config['camera'])
+    source.__enter__()
+    enricher.__enter__()
+    try:
+        for t in source:
+            if stop.is_set() or not _put(ring_out, enricher(t), stop):
+                break
+    finally:
+        source.__exit__(None, None, None)
+        _send_end(ring_out, stop, downstream_workers)
+
+
+def _map_process(make_operator, ring_in, ring_out, stop, done, downstream_workers):
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    operator = make_operator()
+    if hasattr(operator, '__enter__'):
+        operator.__enter__()
+    try:
+        while True:
+            try:
+                t = ring_in.get(stop=stop)
+            except queue.Empty:
+                break
+            if t is None:
+                break
+            if not _put(ring_out, operator(t), stop):
+                break
+    finally:
+        if hasattr(operator, '__exit__'):
+            operator.__exit__(None, None, None)
+        _finish(done, ring_out, stop, downstream_workers)
+
+
+def _sink_process(config, ring_in, stop, sink):
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    operator_profiler.start(config['profile_rate'], config['profile_dir'], owner='metrics')
+    sink.open()
+    window = []
+    window_start = time.monotonic()
+
+    def send_metrics():
+        metrics = compute_metrics(window, config['confidence'], config['metrics_duration'], config['delay'],
+                                  config['repeat'], config['predict_workers'], config['source_type'],
+                                  config['max_age'], config['frame_skip'])
+        if metrics is not None:
+            sink.publish(metrics, 'metrics')
+
+    try:
+        while True:
+            try:
+                t = ring_in.get(stop=stop, timeout=max(0.0, window_start + config['metrics_duration'] - time.monotonic()))
+                if t is None:
+                    break
+            except queue.Empty:
+                if stop.is_set():
+                    break
+                t = None
+            if t is not None:
+                if is_uncertain(t, config['confidence']):
+                    sink.publish(t, 'images')
+                window.append(simplify_classification(t))
+            if time.monotonic() - window_start >= config['metrics_duration']:
+                send_metrics()
+                window = []
+                window_start = time.monotonic()
+        send_metrics()
+    finally:
+        sink.close()
+        operator_profiler.stop('metrics')
+
+
+class EdgeRunner(object):
+    """Wires the edge operators into processes connected by SlotRings.
+
+    Args:
+        app_dir: directory the model and source paths are relative to (the Streams application directory).
+        model_path, first_stage_path: as for DigitPredictor.
+        sources: list of ImageSource filenames, source_type picks one.
+        sink: MemorySink, FileSink, EventStreamsSink or anything with open/publish/close.
+        prep_workers, predict_workers: processes per stage (predict_workers is the 'parallelism').
+        ring_slots, slot_size: shape of each ring buffer.
+        other keyword arguments: the submission parameters of the Streams application.
+    """
+    def __init__(self, app_dir, model_path, sources, sink, source_type=0, delay=0.0, repeat=0,
+                 camera='Camera', confidence=0.70, metrics_duration=10, prep_workers=1, predict_workers=1,
+                 ring_slots=64, slot_size=16384, model_dir='', first_stage_path=None, cascade=0, cascade_threshold=-1.0,
+                 max_age=0.0, frame_skip=0, cameras='', profile_rate=0.0, profile_dir=None):
+        self.ctx = multiprocessing.get_context('fork')
+        self.config = {'app_dir': app_dir, 'model_path': model_path, 'sources': sources, 'source_type': source_type,
+                       'delay': delay, 'repeat': repeat, 'camera': camera, 'confidence': confidence,
+                       'metrics_duration': metrics_duration, 'prep_workers': prep_workers,
+                       'predict_workers': predict_workers, 'model_dir': model_dir, 'first_stage_path': first_stage_path,
+                       'cascade': cascade, 'cascade_threshold': cascade_threshold, 'max_age': max_age,
+                       'frame_skip': frame_skip, 'cameras': cameras, 'profile_rate': profile_rate,
+                       'profile_dir': profile_dir}
+        self.sink = sink
+        self.rings = [SlotRing(ring_slots, slot_size, self.ctx) for i in range(3)]
+        self.stop = self.ctx.Event()
+        self.processes = []
+
+    def _make_prep(self):
+        config = self.config
+        return ImagePrep(max_age=config['max_age'], profile_rate=config['profile_rate'], profile_dir=config['profile_dir'])
+
+    def _make_predictor(self):
+        config = self.config
+        return DigitPredictor(config['model_path'], model_dir=config['model_dir'], first_stage_path=config['first_stage_path'],
+                              cascade=config['cascade'], cascade_threshold=config['cascade_threshold'], app_dir=config['app_dir'],
+                              max_age=config['max_age'], profile_rate=config['profile_rate'], profile_dir=config['profile_dir'])
+
+    def start(self):
+        config = self.config
+        prep_done = self.ctx.Value('i', config['prep_workers'])
+        predict_done = self.ctx.Value('i', config['predict_workers'])
+        self.processes.append(self.ctx.Process(target=_source_process, name="ImageSource",
+                                               args=(config, self.rings[0], self.stop, config['prep_workers'])))
+        for i in range(config['prep_workers']):
+            self.processes.append(self.ctx.Process(target=_map_process, name="PrepareImages-%d" % i,
+                                                   args=(self._make_prep, self.rings[0], self.rings[1], self.stop, prep_done, config['predict_workers'])))
+        for i in range(config['predict_workers']):
+            self.processes.append(self.ctx.Process(target=_map_process, name="PredictDigit-%d" % i,
+                                                   args=(self._make_predictor, self.rings[1], self.rings[2], self.stop, predict_done, 1)))
+        self.processes.append(self.ctx.Process(target=_sink_process, name="ComputeDigitMetrics",
+                                               args=(config, self.rings[2], self.stop, self.sink)))
+        for p in self.processes:
+            p.start()
+
+    def shutdown(self, timeout=10.0):
+        """Stop the source and let the stages drain; anything still running after timeout is terminated."""
+        self.stop.set()
+        self.join(timeout)
+
+    def join(self, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for p in self.processes:
+            p.join(None if deadline is None else max(0.0, deadline - time.monotonic()))
+            if p.is_alive() and deadline is not None:
+                p.terminate()
+                p.join()
+
+    def run(self):
+        """Run until the source is exhausted (repeat > 0) or interrupted."""
+        self.start()
+        try:
+            self.join()
+        except KeyboardInterrupt:
+            print("Interrupted, shutting down", flush=True)
+            self.shutdown()
+
+
+def sink_from_spec(spec, metrics_topic=None, images_topic=None, credentials=None):
+    # 'memory', 'file:<path>' or 'eventstreams' (needs topics and credentials)
+    if spec == 'memory':
+        return MemorySink()
+    if spec.startswith('file:'):
+        return FileSink(spec[len('file:'):])
+    if spec == 'eventstreams':
+        return EventStreamsSink(metrics_topic, images_topic, credentials)
+    raise ValueError("Unknown sink: %s" % (spec,))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Run the edge camera classifier without IBM Streams")
+    parser.add_argument('--app-dir', default='.', help="directory model and source paths are relative to")
+    parser.add_argument('--model', default='etc/HandwrittenDigits_Model')
+    parser.add_argument('--first-stage', default=None, help="cascade first stage file, see digit_cascade")
+    parser.add_argument('--source', action='append', help="ImageSource filename(s); --source-type picks one")
+    parser.add_argument('--source-type', type=int, default=0)
+    parser.add_argument('--delay', type=float, default=0.0)
+    parser.add_argument('--repeat', type=int, default=0)
+    parser.add_argument('--camera', default='Camera')
+    parser.add_argument('--confidence', type=float, default=0.70)
+    parser.add_argument('--metrics-duration', type=float, default=10)
+    parser.add_argument('--prep-workers', type=int, default=1)
+    parser.add_argument('--predict-workers', type=int, default=1)
+    parser.add_argument('--ring-slots', type=int, default=64)
+    parser.add_argument('--slot-size', type=int, default=16384)
+    parser.add_argument('--model-dir', default='')
+    parser.add_argument('--cascade', type=int, default=0)
+    parser.add_argument('--cascade-threshold', type=float, default=-1.0)
+    parser.add_argument('--max-age', type=float, default=0.0, help="latency SLO in seconds, older tuples are shed (0 disables)")
+    parser.add_argument('--frame-skip', type=int, default=0, help="only send one source frame in every FRAME_SKIP + 1")
+    parser.add_argument('--cameras', default='', help="virtual cameras: a number, or a JSON list of per-camera settings")
+    parser.add_argument('--profile-rate', type=float, default=0.0, help="stack samples per second per process (0 disables profiling)")
+    parser.add_argument('--profile-dir', default=None, help="where the collapsed stack profiles are written")
+    parser.add_argument('--sink', default='file:edge-{kind}.jsonl', help="memory, file:<path> or eventstreams")
+    parser.add_argument('--metrics-topic', default='EdgeMetrics')
+    parser.add_argument('--images-topic', default='EdgeUncertainImages')
+    parser.add_argument('--credentials', default=None, help="file holding the Event Streams credentials JSON")
+    args = parser.parse_args()
+
+    credentials = None
+    if args.credentials is not None:
+        with open(args.credentials) as f:
+            credentials = json.load(f)
+    runner = EdgeRunner(args.app_dir, args.model, args.source or ['etc/mnist-test-images'],
+                        sink_from_spec(args.sink, args.metrics_topic, args.images_topic, credentials),
+                        source_type=args.source_type, delay=args.delay, repeat=args.repeat, camera=args.camera,
+                        confidence=args.confidence, metrics_duration=args.metrics_duration,
+                        prep_workers=args.prep_workers, predict_workers=args.predict_workers,
+                        ring_slots=args.ring_slots, slot_size=args.slot_size, model_dir=args.model_dir,
+                        first_stage_path=args.first_stage, cascade=args.cascade, cascade_threshold=args.cascade_threshold,
+                        max_age=args.max_age, frame_skip=args.frame_skip, cameras=args.cameras,
+                        profile_rate=args.profile_rate, profile_dir=args.profile_dir)
+    runner.run()
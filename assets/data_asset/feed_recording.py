@@ -0,0 +1,405 @@
+"""
+Record and replay of the metro feed: the EdgeMetrics and EdgeUncertainImages topics.
+
+    python feed_recording.py record feed-rec --credentials creds.json --duration 600
+    python feed_recording.py replay feed-rec --speed 10 --fanout 20 --sink eventstreams --credentials creds.json
+"""
+import os
+import json
+import time
+import zlib
+import threading
+import collections
+import argparse
+
+import numpy as np
+
+import uncertain_store
+import image_classifier
+
+INDEX_DTYPE = np.dtype([('time', '<f8'),
+                        ('offset', '<u8'),
+                        ('length', '<u4'),
+                        ('camera', '<u4'),
+                        ('kind', 'u1')])
+
+# Channels, as the 'kind' of the edge_runner sinks, in index order
+KINDS = ('metrics', 'images')
+
+# camera column value for messages not from a single camera (metrics)
+NO_CAMERA = 0xFFFFFFFF
+
+# As in uncertain_store, index.bin is written last, so its length is the committed message count.
+# Its rows are in the order messages were recorded, which for several partitions is not time order.
+FN_INDEX = 'index.bin'          # INDEX_DTYPE rows
+FN_MESSAGES = 'messages.bin'    # zlib compressed JSON messages, back to back
+FN_CAMERAS = 'cameras.json'     # camera name table
+
+
+# The cameras a message is about: the tuple's camera, or the cameras of a metrics message
+def message_cameras(message):
+    if 'camera' in message:
+        return [message['camera']]
+    return list(message.get('camera_metrics', {}))
+
+
+# A copy of a message as if it came from camera copy number 'copy' (copy 0 is the original)
+def rename_cameras(message, copy):
+    if copy == 0:
+        return message
+    renamed = dict(message)
+    if 'camera' in message:
+        renamed['camera'] = "%s~%d" % (message['camera'], copy)
+    if 'camera_metrics' in message:
+        renamed['camera_metrics'] = {"%s~%d" % (camera, copy): counts for camera, counts in message['camera_metrics'].items()}
+    return renamed
+
+
+# Kafka's murmur2 hash of a key, as the default partitioners of the Java and kafka-python
+# producers use: partition = (murmur2(key) & 0x7fffffff) % partitions
+def murmur2(data):
+    m = 0x5bd1e995
+    h = (0x9747b28c ^ len(data)) & 0xffffffff
+    end = len(data) & ~3
+    for i in range(0, end, 4):
+        k = (int.from_bytes(data[i:i + 4], 'little') * m) & 0xffffffff
+        k = ((k ^ (k >> 24)) * m) & 0xffffffff
+        h = ((h * m) & 0xffffffff) ^ k
+    extra = len(data) & 3
+    if extra == 3:
+        h ^= data[end + 2] << 16
+    if extra >= 2:
+        h ^= data[end + 1] << 8
+    if extra >= 1:
+        h = ((h ^ data[end]) * m) & 0xffffffff
+    h ^= h >> 13
+    h = (h * m) & 0xffffffff
+    return h ^ (h >> 15)
+
+
+class FeedRecording(object):
+    """Indexed on-disk recording of metro feed messages; reads see everything flushed so far,
+    so a recording can be replayed while it is still being made.
+
+    Args:
+        path: directory holding the recording, created if it does not exist.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.RLock()
+        os.makedirs(path, exist_ok=True)
+
+        cameras_fn = os.path.join(path, FN_CAMERAS)
+        if os.path.exists(cameras_fn):
+            with open(cameras_fn) as f:
+                self.cameras = json.load(f)
+        else:
+            self.cameras = []
+        self._camera_ids = {name: idx for idx, name in enumerate(self.cameras)}
+        self._cameras_dirty = False
+
+        index_fn = self._fn(FN_INDEX)
+        if not os.path.exists(index_fn):
+            open(index_fn, 'wb').close()
+        self._size = os.path.getsize(index_fn) // INDEX_DTYPE.itemsize
+        os.truncate(index_fn, self._size * INDEX_DTYPE.itemsize)
+        messages_fn = self._fn(FN_MESSAGES)
+        if not os.path.exists(messages_fn):
+            open(messages_fn, 'wb').close()
+        self._end = 0
+        if self._size > 0:
+            last = np.memmap(index_fn, dtype=INDEX_DTYPE, mode='r', offset=(self._size - 1) * INDEX_DTYPE.itemsize, shape=(1,))[0]
+            self._end = int(last['offset']) + int(last['length'])
+        os.truncate(messages_fn, self._end)
+
+        self._index_f = None
+        self._messages_f = None
+        self._pending = []
+        self._index = None
+        self._messages = None
+
+    def _fn(self, name):
+        return os.path.join(self.path, name)
+
+    def __len__(self):
+        return self._size
+
+    def record(self, message, kind, received_time=None):
+        """Append one message (a dict, or its JSON as str/bytes) on channel kind."""
+        if isinstance(message, (bytes, str)):
+            data = message.encode('utf-8') if isinstance(message, str) else message
+            message = json.loads(data.decode('utf-8'))
+        else:
+            data = json.dumps(message).encode('utf-8')
+        data = zlib.compress(data)
+        cameras = message_cameras(message)
+        with self._lock:
+            if self._messages_f is None:
+                self._messages_f = open(self._fn(FN_MESSAGES), 'ab')
+                self._index_f = open(self._fn(FN_INDEX), 'ab')
+            camera = NO_CAMERA
+            if len(cameras) == 1 and 'camera' in message:
+                camera = self._camera_ids.get(cameras[0])
+                if camera is None:
+                    camera = self._camera_ids[cameras[0]] = len(self.cameras)
+                    self.cameras.append(cameras[0])
+                    self._cameras_dirty = True
+            self._messages_f.write(data)
+            self._pending.append((time.time() if received_time is None else received_time,
+                                  self._end, len(data), camera, KINDS.index(kind)))
+            self._end += len(data)
+
+    def flush(self):
+        """Commit everything recorded so far: messages and camera names, then the index."""
+        with self._lock:
+            if len(self._pending) == 0:
+                return
+            self._messages_f.flush()
+            if self._cameras_dirty:
+                with open(self._fn(FN_CAMERAS) + '.tmp', 'w') as f:
+                    json.dump(self.cameras, f)
+                os.replace(self._fn(FN_CAMERAS) + '.tmp', self._fn(FN_CAMERAS))
+                self._cameras_dirty = False
+            self._index_f.write(np.array(self._pending, dtype=INDEX_DTYPE).tobytes())
+            self._index_f.flush()
+            self._size += len(self._pending)
+            self._pending = []
+
+    def close(self):
+        with self._lock:
+            self.flush()
+            for f in (self._index_f, self._messages_f):
+                if f is not None:
+                    f.close()
+            self._index_f = self._messages_f = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def index(self):
+        """The committed index rows, memory-mapped (re-mapped when the recording has grown)."""
+        with self._lock:
+            if self._index is None or len(self._index) != self._size:
+                if self._size == 0:
+                    return np.zeros(0, dtype=INDEX_DTYPE)
+                self._index = np.memmap(self._fn(FN_INDEX), dtype=INDEX_DTYPE, mode='r', shape=(self._size,))
+                self._messages = np.memmap(self._fn(FN_MESSAGES), dtype=np.uint8, mode='r',
+                                           shape=(int(self._index[-1]['offset']) + int(self._index[-1]['length']),))
+            return self._index
+
+    def message(self, row):
+        """Decode the message at index row."""
+        entry = self.index()[row]
+        offset = int(entry['offset'])
+        return json.loads(zlib.decompress(self._messages[offset:offset + int(entry['length'])]).decode('utf-8'))
+
+    def rows(self, kinds=None, camera=None, since=None, until=None):
+        """Row numbers in time order, optionally only some channels, one camera, or a time range."""
+        index = self.index()
+        mask = np.ones(len(index), dtype=bool)
+        if kinds is not None:
+            mask &= np.isin(index['kind'], [KINDS.index(kind) for kind in kinds])
+        if camera is not None:
+            if camera not in self._camera_ids:
+                return np.zeros(0, dtype=np.int64)
+            mask &= index['camera'] == self._camera_ids[camera]
+        if since is not None:
+            mask &= index['time'] >= since
+        if until is not None:
+            mask &= index['time'] < until
+        rows = np.nonzero(mask)[0]
+        # Stable, so messages with the same time keep their recorded order
+        return rows[np.argsort(index['time'][rows], kind='stable')]
+
+    def describe(self):
+        index = self.index()
+        counts = collections.Counter(KINDS[k] for k in index['kind'])
+        return {'messages': len(index),
+                'counts': dict(counts),
+                'cameras': len(self.cameras),
+                'start': uncertain_store.format_timestamp(index['time'].min()) if len(index) else None,
+                'duration': float(index['time'].max() - index['time'].min()) if len(index) else 0.0,
+                'bytes': self._end}
+
+
+# Record the Event Streams metrics and images topics until duration seconds or limit messages.
+# The kafka record timestamps (when the edge produced each message) are used as the message times;
+# each poll returns them partition by partition, so they are not recorded in time order.
+def record_eventstreams(recording, credentials, metrics_topic='EdgeMetrics', images_topic='EdgeUncertainImages',
+                        duration=None, limit=None, from_beginning=False, stop=None):
+    import ssl
+    import kafka
+    consumer = kafka.KafkaConsumer(metrics_topic, images_topic,
+                                   bootstrap_servers=credentials["kafka_brokers_sasl"],
+                                   security_protocol="SASL_SSL",
+                                   sasl_mechanism="PLAIN",
+                                   sasl_plain_username=credentials["user"],
+                                   sasl_plain_password=credentials["api_key"],
+                                   ssl_cafile=ssl.get_default_verify_paths().cafile,
+                                   auto_offset_reset='earliest' if from_beginning else 'latest')
+    kinds = {metrics_topic: 'metrics', images_topic: 'images'}
+    deadline = None if duration is None else time.monotonic() + duration
+    recorded = 0
+    try:
+        while (deadline is None or time.monotonic() < deadline) and (limit is None or recorded < limit):
+            if stop is not None and stop.is_set():
+                break
+            parts = consumer.poll(1000, max_records=500)
+            for tp in parts:
+                for item in parts[tp]:
+                    recording.record(item.value, kinds[tp.topic], received_time=item.timestamp / 1000.0)
+                    recorded += 1
+            recording.flush()
+    finally:
+        consumer.close()
+        recording.flush()
+    return recorded
+
+
+class FeedReplayer(object):
+    """Plays a recording back into a sink.
+
+    Args:
+        recording: FeedRecording (or its path).
+        sink: anything with publish(message, kind), e.g. an edge_runner sink or a LocalBroker.
+        speed: 1.0 for the recorded spacing, N for N times faster, 0 for as fast as possible.
+        fanout: copies of each camera; copy k > 0 is sent as camera '<camera>~k'.
+        retime: move the message timestamps (and enrich_time) to when they are replayed.
+        kinds: channels to replay.
+        repeat: passes over the recording, back to back.
+
+    Fan-out copies are shallow, so sinks must not modify messages in place.
+    """
+    def __init__(self, recording, sink, speed=1.0, fanout=1, retime=True, kinds=KINDS, repeat=1):
+        self.recording = recording if isinstance(recording, FeedRecording) else FeedRecording(recording)
+        self.sink = sink
+        self.speed = speed
+        self.fanout = fanout
+        self.retime = retime
+        self.kinds = kinds
+        self.repeat = repeat
+
+    def _retimed(self, message, now):
+        if not self.retime or 'timestamp' not in message:
+            return message
+        message = dict(message)
+        shift = now - uncertain_store.parse_timestamp(message['timestamp'])
+        message['timestamp'] = uncertain_store.format_timestamp(now)
+        if 'enrich_time' in message:
+            message['enrich_time'] += shift
+        return message
+
+    def run(self, stop=None):
+        """Replay, returning counts, the achieved rate and how far behind schedule sending fell."""
+        rows = self.recording.rows(kinds=self.kinds)
+        times = self.recording.index()['time'][rows]
+        kinds = [KINDS[k] for k in self.recording.index()['kind'][rows]]
+        if len(rows) == 0:
+            return {'messages': 0, 'elapsed': 0.0, 'rate': 0.0, 'max_lag': 0.0}
+        span = float(times[-1] - times[0])
+        # Leave the average gap between the end of one pass and the start of the next
+        period = span + (span / (len(rows) - 1) if len(rows) > 1 else 0.0)
+        sent = 0
+        max_lag = 0.0
+        start_time = time.monotonic()
+        for n in range(self.repeat):
+            for row, recorded, kind in zip(rows, times, kinds):
+                if stop is not None and stop.is_set():
+                    break
+                if self.speed:
+                    lag = time.monotonic() - (start_time + (n * period + recorded - times[0]) / self.speed)
+                    if lag < 0:
+                        time.sleep(-lag)
+                    max_lag = max(max_lag, lag)
+                message = self._retimed(self.recording.message(row), time.time())
+                for copy in range(self.fanout):
+                    self.sink.publish(rename_cameras(message, copy), kind)
+                    sent += 1
+        elapsed = time.monotonic() - start_time
+        return {'messages': sent, 'elapsed': elapsed, 'rate': sent / elapsed if elapsed > 0 else 0.0, 'max_lag': max_lag}
+
+
+class LocalBroker(object):
+    """In-process stand-in for the two Event Streams topics, for replays without a broker.
+
+    Args:
+        partitions: partitions per topic; messages are placed by their camera key, as
+            the edge does, so one partition always holds all of a camera's messages.
+        max_messages: messages kept per partition, the oldest are dropped past it.
+    """
+    def __init__(self, partitions=3, max_messages=10000):
+        self.partitions = partitions
+        self.topics = {kind: [collections.deque(maxlen=max_messages) for i in range(partitions)] for kind in KINDS}
+        self.published = collections.Counter()
+        self._ready = threading.Condition()
+
+    def open(self):
+        pass
+
+    def publish(self, message, kind):
+        key = image_classifier.message_key(message)
+        with self._ready:
+            self.topics[kind][(murmur2(key.encode('utf-8')) & 0x7fffffff) % self.partitions].append(message)
+            self.published[kind] += 1
+            self._ready.notify_all()
+
+    # The oldest waiting messages, from one partition (a consumer in a parallel region) or all of them
+    def poll(self, kind, partition=None, max_messages=100, timeout=None):
+        partitions = self.topics[kind] if partition is None else [self.topics[kind][partition]]
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._ready:
+            while True:
+                messages = []
+                for queue in partitions:
+                    while len(queue) > 0 and len(messages) < max_messages:
+                        messages.append(queue.popleft())
+                if len(messages) > 0 or deadline is None or time.monotonic() >= deadline:
+                    return messages
+                self._ready.wait(deadline - time.monotonic())
+
+    def close(self):
+        pass
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Record or replay the metro feed")
+    parser.add_argument('command', choices=['record', 'replay', 'info'])
+    parser.add_argument('recording', help="recording directory")
+    parser.add_argument('--credentials', default=None, help="file holding the Event Streams credentials JSON")
+    parser.add_argument('--metrics-topic', default='EdgeMetrics')
+    parser.add_argument('--images-topic', default='EdgeUncertainImages')
+    parser.add_argument('--duration', type=float, default=None, help="record: seconds to record for")
+    parser.add_argument('--limit', type=int, default=None, help="record: messages to record")
+    parser.add_argument('--from-beginning', action='store_true', help="record: start from the oldest retained messages")
+    parser.add_argument('--speed', type=float, default=1.0, help="replay: time scale, 0 for as fast as possible")
+    parser.add_argument('--fanout', type=int, default=1, help="replay: copies of each camera")
+    parser.add_argument('--repeat', type=int, default=1, help="replay: passes over the recording")
+    parser.add_argument('--keep-timestamps', action='store_true', help="replay: send the recorded timestamps")
+    parser.add_argument('--sink', default='eventstreams', help="replay: eventstreams, file:<path> or memory")
+    args = parser.parse_args()
+
+    credentials = None
+    if args.credentials is not None:
+        with open(args.credentials) as f:
+            credentials = json.load(f)
+    with FeedRecording(args.recording) as recording:
+        if args.command == 'record':
+            print("Recorded %d messages" % record_eventstreams(recording, credentials, args.metrics_topic, args.images_topic,
+                                                               duration=args.duration, limit=args.limit,
+                                                               from_beginning=args.from_beginning))
+        elif args.command == 'replay':
+            import edge_runner
+            sink = edge_runner.sink_from_spec(args.sink, args.metrics_topic, args.images_topic, credentials)
+            sink.open()
+            try:
+                result = FeedReplayer(recording, sink, speed=args.speed, fanout=args.fanout,
+                                      retime=not args.keep_timestamps, repeat=args.repeat).run()
+            finally:
+                sink.close()
+            print("Replayed %d messages in %.1fs (%.1f msg/s), at most %.3fs behind schedule" % (
+                  result['messages'], result['elapsed'], result['rate'], result['max_lag']))
+        for key, value in recording.describe().items():
+            print("%-10s %s" % (key, value))
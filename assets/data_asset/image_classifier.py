@@ -1,90 +1,387 @@
+import time
+_module_start_time = time.monotonic()
 import io
 import os
 import sys
-import time
+import queue
 import datetime
-import PIL
-import joblib
-import streamsx.ec
-import numpy as np
+import collections
+import threading
 import base64
 
 if 'scripts' not in sys.path:
     sys.path.insert(0, 'scripts')
 
+import lazy_import
+import operator_profiler
+import model_files
+# Local modules are imported eagerly, so the topology dependency resolver sees and bundles them;
+# they defer their own heavy imports.
 import image_processing
+import digit_cascade
+
+# Heavy modules are only imported by the operators that use them (e.g. the metrics aggregate
+# never needs PIL or joblib).  streamsx.ec is not needed at all when an app_dir is given,
+# as in standalone use (see edge_runner).
+np = lazy_import.lazy_module('numpy')
+joblib = lazy_import.lazy_module('joblib')
+Image = lazy_import.lazy_module('PIL.Image')
+ec = lazy_import.lazy_module('streamsx.ec')
+
+# Sleep of the thread that measures how long scoring is held up while a new model is loaded
+PAUSE_PROBE = 0.001
+
+# A blank 28x28 image for warm-up inferences, in the form ImagePrep produces
+WARMUP_IMAGE = [[0] * 28 for i in range(28)]
+
+# Fields of a classified tuple that the metrics aggregate needs (the images are dropped)
+SIMPLIFIED_KEYS = ('camera', 'result_class', 'result_probability', 'prep_time', 'predict_time',
+                   'model_version', 'predict_stage', 'startup', 'model_load_time', 'model_warmup_time', 'model_swap_pause',
+                   'timestamp', 'age', 'shed', 'skipped', 'dropped')
+
+
+def simplify_classification(t):
+    return {key: t[key] for key in SIMPLIFIED_KEYS if key in t}
+
+
+# Normalize a max_age latency SLO (seconds, or a submission parameter callable) to None when disabled
+def resolve_max_age(max_age):
+    if callable(max_age):
+        max_age = max_age()
+    max_age = float(max_age) if max_age else 0.0
+    return max_age if max_age > 0 else None
+
+
+# Load shedding: a tuple that is already older than the max_age SLO is replaced by this small
+# record.  Later stages pass it through untouched, and compute_metrics counts it.
+def shed_record(t, stage, age):
+    shed = {'camera': t['camera'], 'count': t.get('count'), 'timestamp': t['timestamp'], 'shed': stage, 'age': age}
+    for key in ('skipped', 'dropped'):
+        if key in t:
+            shed[key] = t[key]
+    return shed
+
+
+# The tuples sent home for review: scored ones the model is not confident about, and for
+# testing everything from Test cameras.  Shed tuples were never scored.
+def is_uncertain(t, confidence):
+    return 'shed' not in t and (t['result_probability'] <= confidence or t['camera'].startswith("Test"))
 
 
 # Class operator to handle the model and score tuples
 class DigitPredictor(object):
     """
     Callable class that loads the model from a file, loaded model used to predict the digits.    
-    
+
+    If a model directory is given, newer versions (<model>-v2, ...) found there or asked for with
+    request_model() are loaded in the background and swapped in between tuples, see load_model().
+
+    In cascade mode a cheap digit_cascade.LinearStage answers first, and predict_stage (1 or 2)
+    records which stage scored the image.
+
+    With a max_age, tuples older than that since the Enricher are shed instead of scored, see shed_record().
     """
 
-    def __init__(self, model_path):
+    def __init__(self, model_path, model_dir=None, poll_interval=30.0, first_stage_path=None, cascade=None, cascade_threshold=None, app_dir=None, max_age=None, profile_rate=None, profile_dir=None):
         # Note this method is only called when the topology is
         # declared to create a instance to use in the map function.
+        # model_dir, cascade and cascade_threshold may be submission parameter callables;
+        # an empty model_dir disables watching, cascade=0 disables the first stage, and a
+        # negative cascade_threshold keeps the threshold tuned into the first stage file.
+        # app_dir replaces the Streams application directory, for standalone use.
+        # max_age (seconds, may be a submission parameter callable) of 0 disables shedding.
+        # profile_rate/profile_dir start the operator_profiler, see ImageSource.
         self.model_path = model_path
-        self._clf = None
+        self.profile_rate = profile_rate
+        self.profile_dir = profile_dir
+        self.app_dir = app_dir
+        self.model_dir = model_dir
+        self.poll_interval = poll_interval
+        self.first_stage_path = first_stage_path
+        self.cascade = cascade
+        self.cascade_threshold = cascade_threshold
+        self.max_age = max_age
+        self._max_age = None
+        self._first_stage = None
+        self._active = None
+        self._requests = None
+        self._stop = None
+        self._watcher = None
+        self._startup_report = None
+        self.model_loads = []
 
     def __call__(self, t):
         """Predict the digit from the image.
         """
+        if 'shed' in t:
+            return t
+        if 'enrich_time' in t:
+            t['age'] = time.time() - t['enrich_time']
+            if self._max_age is not None and t['age'] > self._max_age:
+                return shed_record(t, 'predict', t['age'])
+        # Read the active model once, so a swap mid-tuple cannot mix versions.
+        clf, model_info = self._active
         start_time = time.monotonic()
-        digit_prediction = self._clf.predict_proba(np.array(t['prepared_image']).reshape(1, -1))[0] # a numpy array
+        image = np.array(t['prepared_image']).reshape(1, -1)
+        digit_prediction = None
+        if self._first_stage is not None:
+            digit_prediction = self._first_stage.predict_proba(image)[0]
+            t['predict_stage'] = 1
+            if digit_prediction.max() < self._first_stage.threshold:
+                digit_prediction = None
+        if digit_prediction is None:
+            digit_prediction = clf.predict_proba(image)[0] # a numpy array
+            if self._first_stage is not None:
+                t['predict_stage'] = 2
         t['predictions'] = digit_prediction.tolist()
         t['result_class'] = int(np.argmax(digit_prediction))
         t['result_probability'] = float(digit_prediction[t['result_class']])
         t['predict_time'] = time.monotonic() - start_time
+        t['model_version'] = model_info['version']
+        t['model_load_time'] = model_info['load_time']
+        t['model_warmup_time'] = model_info['warmup_time']
+        t['model_swap_pause'] = model_info['swap_pause']
+        if self._startup_report is not None:
+            # Only the first scored tuple carries the report, so it lands in the first metrics message
+            t['startup'] = self._startup_report
+            self._startup_report = None
         return t
 
+    def load_model(self, path, version, probe=False):
+        """Load and warm up a model, returning it with its load information.
+
+        Unpickling holds the GIL, so a load in the background still stalls scoring; with probe,
+        the longest stall a thread saw during the load is recorded as its swap_pause.
+        """
+        pauses = []
+        if probe:
+            loaded = threading.Event()
+            prober = threading.Thread(target=self._probe_pause, args=(loaded, pauses), name="DigitPredictorPauseProbe", daemon=True)
+            prober.start()
+        start_time = time.monotonic()
+        clf = joblib.load(path)
+        load_time = time.monotonic() - start_time
+        # The first predict pays one-off costs (lazy allocations, caches), keep those off the scoring path.
+        start_time = time.monotonic()
+        clf.predict_proba(np.array(WARMUP_IMAGE).reshape(1, -1))
+        warmup_time = time.monotonic() - start_time
+        if probe:
+            loaded.set()
+            prober.join()
+        model_info = {'version': version, 'path': path, 'load_time': load_time, 'warmup_time': warmup_time,
+                      'swap_pause': max(pauses) if pauses else 0.0}
+        print("Loaded model v%d: %s (load %.3fs, warm-up %.3fs, scoring paused up to %.3fs)" % (
+              version, path, load_time, warmup_time, model_info['swap_pause']), flush=True)
+        self.model_loads.append(model_info)
+        return clf, model_info
+
+    @staticmethod
+    def _probe_pause(loaded, pauses):
+        # Oversleep of a short sleep is the time waited for the GIL, as the scoring thread would
+        while not loaded.is_set():
+            start_time = time.monotonic()
+            time.sleep(PAUSE_PROBE)
+            pauses.append(time.monotonic() - start_time - PAUSE_PROBE)
+
+    def request_model(self, path, version):
+        """Ask for a specific model file to be loaded in the background and swapped in.
+        """
+        self._requests.put((path, version))
+        if self._watcher is None:
+            self._start_watcher()
+
+    def _start_watcher(self):
+        self._watcher = threading.Thread(target=self._watch, name="DigitPredictorModelWatch", daemon=True)
+        self._watcher.start()
+
+    def _watch(self):
+        # Background thread: serve explicit requests, and poll the model directory between them.
+        while not self._stop.is_set():
+            try:
+                request = self._requests.get(timeout=self.poll_interval)
+            except queue.Empty:
+                request = None
+            try:
+                if request is None and self.model_dir:
+                    version, path = model_files.latest_model(os.path.join(self.model_dir, os.path.basename(self.model_path)))
+                    if version is not None and version > self._active[1]['version']:
+                        request = (path, version)
+                if request is not None and not self._stop.is_set():
+                    self._active = self.load_model(*request, probe=True)
+            except Exception as e:
+                print("Model swap failed, keeping v%d:" % (self._active[1]['version'],), e, flush=True)
+
     def __enter__(self):
         """Load the model from a file.
         """
         # Called at runtime in the IBM Streams job before
         # this instance starts processing tuples.
-        print("Loading model:", os.path.join(streamsx.ec.get_application_directory(), self.model_path), flush=True)
-        self._clf = joblib.load(
-            os.path.join(streamsx.ec.get_application_directory(), self.model_path)
-        )
+        enter_start_time = time.monotonic()
+        operator_profiler.start(self.profile_rate, self.profile_dir, owner=self)
+        lazy_import.load(np, joblib)
+        app_dir = self.app_dir if self.app_dir is not None else ec.get_application_directory()
+        path = os.path.join(app_dir, self.model_path)
+        print("Loading model:", path, flush=True)
+        self._active = self.load_model(path, 1)
+
+        cascade = self.cascade() if callable(self.cascade) else self.cascade
+        if cascade and int(cascade) and self.first_stage_path is not None:
+            self._first_stage = digit_cascade.LinearStage.load(os.path.join(app_dir, self.first_stage_path))
+            threshold = self.cascade_threshold() if callable(self.cascade_threshold) else self.cascade_threshold
+            if threshold is not None and float(threshold) >= 0:
+                self._first_stage.threshold = float(threshold)
+            print("Cascade enabled, first stage threshold %.4f" % (self._first_stage.threshold,), flush=True)
+
+        if callable(self.model_dir):
+            self.model_dir = self.model_dir()
+        self._max_age = resolve_max_age(self.max_age)
+        self._requests = queue.Queue()
+        self._stop = threading.Event()
+        # Without a directory to poll, the watch thread is only started by request_model()
+        if self.model_dir:
+            self._start_watcher()
+
+        # Run one blank image through the whole scoring path, so first-call costs (array
+        # conversion, first stage, result handling) are not charged to the first real predict_time.
+        start_time = time.monotonic()
+        self({'prepared_image': WARMUP_IMAGE})
+        path_warmup_time = time.monotonic() - start_time
+
+        report = lazy_import.import_report()
+        report['module_import_time'] = module_import_time
+        report['model_load_time'] = self._active[1]['load_time']
+        report['warmup_time'] = self._active[1]['warmup_time'] + path_warmup_time
+        report['enter_time'] = time.monotonic() - enter_start_time
+        print("Startup: imports %.3fs (%s), model load %.3fs, warm-up %.3fs, ready in %.3fs" % (
+              report['import_time'] + report['module_import_time'],
+              ", ".join("%s %.3fs" % (name, seconds) for name, seconds in sorted(report['imports'].items())),
+              report['model_load_time'], report['warmup_time'], report['enter_time']), flush=True)
+        self._startup_report = report
 
     def __exit__(self, exc_type, exc_value, traceback):
         # __enter__ and __exit__ must both be defined.
-        pass
+        if self._stop is not None:
+            self._stop.set()
+        operator_profiler.stop(self)
 
 # Read in the image blob and do image manipulation to prepare for scoring
+# With a max_age (seconds, may be a submission parameter callable), tuples already older than
+# that are shed before the image work, see shed_record().  profile_rate/profile_dir start the
+# operator_profiler, see ImageSource.
 class ImagePrep(object):
-    def __init__(self):
-        pass
+    def __init__(self, max_age=None, profile_rate=None, profile_dir=None):
+        self.max_age = max_age
+        self._max_age = None
+        self.profile_rate = profile_rate
+        self.profile_dir = profile_dir
+    def __enter__(self):
+        operator_profiler.start(self.profile_rate, self.profile_dir, owner=self)
+        self._max_age = resolve_max_age(self.max_age)
+        # The first image opened pays for loading PIL and its PNG plugin; do that now on a blank image.
+        start_time = time.monotonic()
+        with io.BytesIO() as f:
+            Image.new('L', (28, 28), color=255).save(f, 'PNG')
+            self({'image': base64.b64encode(f.getvalue())})
+        print("ImagePrep warm-up %.3fs" % (time.monotonic() - start_time,), flush=True)
+    def __exit__(self, exc_type, exc_value, traceback):
+        # __enter__ and __exit__ must both be defined.
+        operator_profiler.stop(self)
     def __call__(self, t):
+        if self._max_age is not None and 'enrich_time' in t:
+            age = time.time() - t['enrich_time']
+            if age > self._max_age:
+                return shed_record(t, 'prep', age)
         start_time = time.monotonic()
         with io.BytesIO(base64.b64decode(t['image'])) as f:
-            with PIL.Image.open(f) as image:
+            with Image.open(f) as image:
                 prepped_image = image_processing.file_loaded_preprep(image)
                 resized_image = image_processing.square_fit_resize(prepped_image)
                 t['prepared_image'] = np.array(image_processing.center_by_pixel_mass(resized_image)).tolist()
         t['prep_time'] = time.monotonic() - start_time
         return t
 
+# Event Streams message key for a tuple or metrics message: the camera, so all of a camera's
+# messages land in the same partition (and so the same metro parallel channel), in order.
+# A metrics message covering several cameras is keyed by all of them.
+def message_key(message):
+    if 'camera' in message:
+        return message['camera']
+    return ",".join(sorted(message.get('camera_metrics', {})))
+
+# min/max/mean/std/percentiles of a list of times, or None if it is empty
+def distribution(values):
+    if len(values) == 0:
+        return None
+    values = np.array(values)
+    return {
+      'min': float(values.min()),
+      'max': float(values.max()),
+      'mean': float(values.mean()),
+      'std': float(values.std()),
+      'percentiles': np.percentile(values, [50, 75, 90, 99]).tolist()
+    }
+
 # Compute per-camera digit count metrics from a set of results in a window
 # We also distinguish between cases where we were fairly certain and cases where we were not.
-def compute_metrics(tuples, threshold, duration, delay, repeat, parallelism, source):
+# Shed tuples (and frames skipped at the source, or dropped by a virtual camera that fell
+# behind) are counted per camera by where they were dropped, with the ages of the shed and
+# the scored tuples.
+def compute_metrics(tuples, threshold, duration, delay, repeat, parallelism, source, max_age=None, frame_skip=None):
     if len(tuples) > 0:
-        prep_times = np.array([x['prep_time'] for x in tuples])
-        predict_times = np.array([x['predict_time'] for x in tuples])
+        scored = [x for x in tuples if 'shed' not in x]
+        prep_times = [x['prep_time'] for x in scored]
+        predict_times = [x['predict_time'] for x in scored]
         counts = dict()
+        ages = dict()
         for t in tuples:
             if t['camera'] not in counts:
                 counts[t['camera']] = {'certain': [0 for i in range(11)],
-                                       'uncertain': [0 for i in range(11)]}
+                                       'uncertain': [0 for i in range(11)],
+                                       'shed': {'source': 0, 'dropped': 0, 'prep': 0, 'predict': 0}}
+                ages[t['camera']] = {'scored': [], 'shed': []}
+            counts[t['camera']]['shed']['source'] += t.get('skipped', 0)
+            counts[t['camera']]['shed']['dropped'] += t.get('dropped', 0)
+            if 'shed' in t:
+                shed = counts[t['camera']]['shed']
+                shed[t['shed']] = shed.get(t['shed'], 0) + 1
+                ages[t['camera']]['shed'].append(t['age'])
+                continue
+            if 'age' in t:
+                ages[t['camera']]['scored'].append(t['age'])
             if t['result_probability'] > threshold:
                 counts[t['camera']]['certain'][t['result_class']] += 1
             else:
                 counts[t['camera']]['uncertain'][t['result_class']] += 1
+        for camera in counts:
+            counts[camera]['age'] = {'scored': distribution(ages[camera]['scored']),
+                                     'shed': distribution(ages[camera]['shed'])}
+
+        # Startup reports from DigitPredictor instances that started since the last window
+        startup = [t['startup'] for t in scored if t.get('startup') is not None]
+
+        # How many images the cascade first stage answered on its own
+        stages = collections.Counter(t['predict_stage'] for t in scored if 'predict_stage' in t)
+        cascade = {'stage1': stages[1], 'stage2': stages[2]} if len(stages) > 0 else None
+
+        # Which model versions scored this window, and how long the newest one took to come up
+        model_versions = collections.Counter(t['model_version'] for t in scored if 'model_version' in t)
+        model = None
+        if len(model_versions) > 0:
+            newest = max(model_versions)
+            newest_tuple = next(t for t in scored if t.get('model_version') == newest)
+            model = {
+                'version': newest,
+                'version_counts': {str(v): c for v, c in model_versions.items()},
+                'load_time': newest_tuple['model_load_time'],
+                'warmup_time': newest_tuple['model_warmup_time'],
+                'swap_pause': newest_tuple.get('model_swap_pause')
+            }
         
         return {
                   'camera_metrics': counts,
+                  'model': model,
+                  'cascade': cascade,
+                  'startup': startup if len(startup) > 0 else None,
                   'timestamp': datetime.datetime.utcnow().isoformat() + 'Z',
                   'config': {
                     'delay': delay,
@@ -92,25 +389,23 @@ def compute_metrics(tuples, threshold, duration, delay, repeat, parallelism, sou
                     'source': source,
                     'confidence': threshold,
                     'classify_parallel': parallelism,
-                    'metrics_duration': duration
+                    'metrics_duration': duration,
+                    'max_age': max_age,
+                    'frame_skip': frame_skip
                   },
                   'latency_metrics': {
-                    'prep': {
-                      'min': float(prep_times.min()),
-                      'max': float(prep_times.max()),
-                      'mean': float(prep_times.mean()),
-                      'std': float(prep_times.std()),
-                      'percentiles': np.percentile(prep_times, [50, 75, 90, 99]).tolist()
-                    },
-                    'predict': {
-                      'min': float(predict_times.min()),
-                      'max': float(predict_times.max()),
-                      'mean': float(predict_times.mean()),
-                      'std': float(predict_times.std()),
-                      'percentiles': np.percentile(predict_times, [50, 75, 90, 99]).tolist()
-                    }
+                    'prep': distribution(prep_times),
+                    'predict': distribution(predict_times)
                   }
                 }
     else:
         return None
-      
+
+
+operator_profiler.register('ImagePrep', ImagePrep.__call__)
+operator_profiler.register('DigitPredictor', DigitPredictor.__call__)
+operator_profiler.register('compute_metrics', compute_metrics)
+
+
+# Time spent importing this module itself (the heavy modules above are deferred)
+module_import_time = time.monotonic() - _module_start_time
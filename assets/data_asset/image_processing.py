@@ -1,22 +1,29 @@
 import numpy as np
-from PIL import Image, ImageOps
+
+import lazy_import
+
+Image = lazy_import.lazy_module('PIL.Image')
+ImageOps = lazy_import.lazy_module('PIL.ImageOps')
 
 # Compute the pixel center of mass of a given image, stored in a 2-D numpy array.
 def computeCOM(i):
-    xsum = 0
-    ysum = 0
-    msum = 0
-    height, width = i.shape
-    for x in range(width):
-        for y in range(height):
-            msum += i[y][x]
-            xsum += x*i[y][x]
-            ysum += y*i[y][x]
-    if msum > 0:
-        return (xsum/msum, ysum/msum)
-    else:
-        # For empty images, return the center, I guess
-        return (width/2, height/2)
+    (com_x, com_y), = batch_center_of_mass(np.asarray(i)[np.newaxis])
+    return (com_x, com_y)
+
+
+# Pixel centers of mass for a stack of images, (N, height, width) -> (N, 2) array of (x, y).
+def batch_center_of_mass(images):
+    images = np.asarray(images, dtype=np.float64)
+    n, height, width = images.shape
+    msum = images.sum(axis=(1, 2))
+    xsum = images.sum(axis=1) @ np.arange(width)
+    ysum = images.sum(axis=2) @ np.arange(height)
+    # For empty images, return the center, I guess
+    empty = msum <= 0
+    msum[empty] = 1
+    com = np.stack([xsum / msum, ysum / msum], axis=1)
+    com[empty] = (width / 2, height / 2)
+    return com
     
     
 # Prepare the image to be scored.
@@ -96,5 +103,24 @@ def center_by_pixel_mass(image, target_size=28):
     target_image.paste(image, box=new_origin)
     
     return target_image
-  
-  
\ No newline at end of file
+
+
+# Batch version of center_by_pixel_mass, for (N, size, size) intermediate images as arrays.
+# Matches pasting each image into the target canvas with PIL (clipping at the edges), but
+# computes the centers of mass for the whole batch at once.
+def batch_center_by_pixel_mass(images, target_size=28):
+    images = np.asarray(images)
+    n, height, width = images.shape
+    com = batch_center_of_mass(images)
+    # Same rounding as center_by_pixel_mass (Python round: half to even, like np.round)
+    origins = np.round(target_size / 2 - com).astype(int)
+    targets = np.zeros((n, target_size, target_size), dtype=images.dtype)
+    for idx, (x0, y0) in enumerate(origins):
+        # Clip the pasted image to the canvas
+        sx, sy = max(0, -x0), max(0, -y0)
+        tx, ty = max(0, x0), max(0, y0)
+        w = min(width - sx, target_size - tx)
+        h = min(height - sy, target_size - ty)
+        if w > 0 and h > 0:
+            targets[idx, ty:ty + h, tx:tx + w] = images[idx, sy:sy + h, sx:sx + w]
+    return targets
@@ -1,15 +1,197 @@
 import time
 import os
 import sys
-import streamsx.ec
+import json
+import heapq
+import base64
+import socket
+import datetime
+
+import numpy as np
+
+try:
+    import streamsx.ec
+except ImportError:
+    # Standalone use (see edge_runner), without the Streams runtime; an app_dir must be given.
+    streamsx = None
 
 if 'scripts' not in sys.path:
     sys.path.insert(0, 'scripts')
 
 import mnist_index_files
+import operator_profiler
+
+
+# Degrade a 28x28 MNIST image (bright digit on black) like a poor camera: scale the
+# contrast, move it up to shift pixels each way, box blur it 'blur' times and add
+# gaussian noise with standard deviation 'noise' (in 0-255 units).
+def degrade(image, rng, noise=0.0, contrast=1.0, shift=0, blur=0):
+    image = image.astype(np.float32) * contrast
+    if shift:
+        image = np.roll(image, tuple(rng.randint(-shift, shift + 1, size=2)), axis=(0, 1))
+    for i in range(blur):
+        padded = np.pad(image, 1, mode='edge')
+        image = sum(padded[dy:dy + image.shape[0], dx:dx + image.shape[1]] for dy in range(3) for dx in range(3)) / 9.0
+    if noise:
+        image = image + rng.normal(0.0, noise, size=image.shape)
+    return np.clip(image, 0, 255).astype(np.uint8)
+
+
+class VirtualCamera(object):
+    """One emulated camera of a multi-camera ImageSource.
+
+    Args:
+        name: added to the Enricher's camera name, so each camera reports separately.
+        units: the mnist_index_files.IdxReader the images come from, shared by all cameras.
+        interval: seconds between frames, 0 for as fast as the source can go.
+        offset: index of the camera's first image in the data set.
+        images: images per pass, from offset on (wrapping around), None for the whole data set.
+        repeat: passes, None (or 0) for forever.
+        noise, contrast, shift, blur: degradation profile, see degrade().
+        seed: for the degradation, so runs are repeatable.
+    """
+    def __init__(self, name, units, interval=0.0, offset=0, images=None, repeat=None, noise=0.0, contrast=1.0, shift=0, blur=0, seed=0):
+        self.name = name
+        self.units = units
+        self.interval = interval
+        self.offset = offset % len(units)
+        self.images = len(units) if images is None else images
+        if self.images < 1:
+            raise ValueError("Virtual camera %s needs at least one image per pass" % (name,))
+        self.position = self.offset
+        self.repeat = repeat or None
+        self.profile = {'noise': noise, 'contrast': contrast, 'shift': shift, 'blur': blur}
+        self.degraded = noise or contrast != 1.0 or shift or blur
+        self.rng = np.random.RandomState(seed)
+        self.count = -1
+        self.skipped = 0
+        self.dropped = 0
+        self._left = self.images
+
+    def _advance(self):
+        # Move on to the next frame, returning its index in the data set, or None once exhausted
+        if self._left == 0:
+            if self.repeat is not None:
+                self.repeat -= 1
+                if self.repeat <= 0:
+                    return None
+            self._left = self.images
+            self.position = self.offset
+        frame = self.position
+        self.position = (self.position + 1) % len(self.units)
+        self._left -= 1
+        self.count += 1
+        return frame
+
+    def drop(self, frames):
+        """Pass over frames the camera missed; they still count towards its passes and 'count'."""
+        for i in range(frames):
+            if self._advance() is None:
+                return
+            self.dropped += 1
+
+    def capture(self):
+        """The next frame as a 28x28 array, or None once the camera is exhausted."""
+        frame = self._advance()
+        if frame is None:
+            return None
+        image = self.units[frame]
+        if self.degraded:
+            image = degrade(image, self.rng, **self.profile)
+        return image
+
+
+# Virtual cameras from the 'cameras' submission parameter: either a number of cameras, which
+# each take an equal part of the data set and run at the source delay, or a JSON list with one
+# object per camera, all keys optional:
+#   [{"name": "door", "rate": 5, "offset": 0}, {"rate": 2, "offset": 5000, "noise": 40, "blur": 1}]
+# rate is in frames/sec (0 for as fast as possible), the other keys are as for VirtualCamera.
+def virtual_cameras(cameras, units, delay, repeat):
+    if isinstance(cameras, str):
+        cameras = json.loads(cameras) if cameras.strip().startswith('[') else int(cameras)
+    if isinstance(cameras, int):
+        if cameras > len(units):
+            raise ValueError("%d virtual cameras, but only %d images to share between them" % (cameras, len(units)))
+        cameras = [{'offset': idx * len(units) // cameras, 'images': len(units) // cameras} for idx in range(cameras)]
+    virtual = []
+    for idx, spec in enumerate(cameras):
+        spec = dict(spec)
+        rate = spec.pop('rate', None)
+        interval = delay if rate is None else (1.0 / rate if rate else 0.0)
+        virtual.append(VirtualCamera(spec.pop('name', 'v%d' % idx), units, interval=interval or 0.0,
+                                     repeat=spec.pop('repeat', repeat), seed=spec.pop('seed', idx), **spec))
+    return virtual
+
+
+class VirtualCameras(object):
+    """Interleaves the frames of several virtual cameras into one stream of tuples.
+
+    The camera whose next frame is due soonest goes next, so every camera keeps its own
+    rate while the source keeps up, and they take turns once it cannot.  Like a real camera,
+    one that falls behind drops the frames it missed rather than bursting: its tuple 'count'
+    jumps by the frames dropped, which the next tuple carries as 'dropped'.  With frame_skip,
+    each camera only submits one frame in every frame_skip + 1.
+    """
+    def __init__(self, cameras, frame_skip=0):
+        self.cameras = cameras
+        self.frame_skip = frame_skip
+        now = time.monotonic()
+        # (due time, frames taken, camera index): the frame count breaks ties round-robin
+        self._due = [(now, 0, idx) for idx in range(len(cameras))]
+        heapq.heapify(self._due)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        while len(self._due) > 0:
+            due, frames, idx = self._due[0]
+            now = time.monotonic()
+            if due > now:
+                time.sleep(due - now)
+                now = due
+            camera = self.cameras[idx]
+            missed = 0
+            if camera.interval > 0:
+                missed = int((now - due) / camera.interval)
+                camera.drop(missed)
+            image = camera.capture()
+            if image is None:
+                print("Virtual camera %s exhausted." % (camera.name,), flush=True)
+                heapq.heappop(self._due)
+                continue
+            heapq.heapreplace(self._due, (due + (missed + 1) * camera.interval if camera.interval > 0 else now, frames + 1, idx))
+            if camera.skipped < self.frame_skip:
+                camera.skipped += 1
+                continue
+            with mnist_index_files.to_filehandle(image) as f:
+                t = {'count': camera.count, 'camera': camera.name, 'image': f.read()}
+            if camera.skipped > 0:
+                t['skipped'] = camera.skipped
+                camera.skipped = 0
+            if camera.dropped > 0:
+                t['dropped'] = camera.dropped
+                camera.dropped = 0
+            return t
+        print("Done repeating.  All virtual cameras exhausted.")
+        raise StopIteration
+
 
 class ImageSource(object):
-    def __init__(self, source_type, filenames, delay, repeat):
+    def __init__(self, source_type, filenames, delay, repeat, app_dir=None, frame_skip=None, cameras=None, profile_rate=None, profile_dir=None):
+        # frame_skip (optionally a submission parameter callable) sheds load at the source:
+        # only one frame in every frame_skip + 1 is submitted, the camera still runs at its
+        # delay, and each submitted tuple counts the frames 'skipped' before it.
+        # cameras (optionally a submission parameter callable) switches to emulating several
+        # cameras from an MNIST source, see virtual_cameras(); empty or 0 is one real camera.
+        # profile_rate/profile_dir (optionally submission parameter callables) start the
+        # operator_profiler; a rate of 0 leaves it off.
+        self._app_dir = app_dir
+        self._profile_rate = profile_rate
+        self._profile_dir = profile_dir
+        self._frame_skip = frame_skip
+        self._cameras = cameras
+        self._virtual = None
         self._delay = delay
         self._repeat = repeat
         self._filenames = filenames
@@ -18,6 +200,7 @@ class ImageSource(object):
         self._count = -1
                 
     def __enter__(self):
+        operator_profiler.start(self._profile_rate, self._profile_dir, owner=self)
         # Get the submission time parameters and normalize them
         self._delay = float(self._delay())
         self._repeat = int(self._repeat())
@@ -28,12 +211,27 @@ class ImageSource(object):
             self._delay = None
         if self._repeat == 0:
             self._repeat = None
+        if callable(self._frame_skip):
+            self._frame_skip = self._frame_skip()
+        self._frame_skip = int(self._frame_skip) if self._frame_skip else 0
 
-        print("Entering ImageSource operator with delay=%f, repeat=%d, source=%d (from %s)" % (self._delay if self._delay is not None else 0.0,
+        print("Entering ImageSource operator with delay=%f, repeat=%d, frame_skip=%d, source=%d (from %s)" % (self._delay if self._delay is not None else 0.0,
                                                                                                self._repeat if self._repeat is not None else 0,
+                                                                                               self._frame_skip,
                                                                                                self._source_type,
                                                                                                self._filenames[self._source_type]))
 
+        if callable(self._cameras):
+            self._cameras = self._cameras()
+        if self._cameras and self._cameras not in ('0', 0):
+            if self._source_type >= 2:
+                raise ValueError("Virtual cameras need an MNIST index file source")
+            units = mnist_index_files.IdxReader(os.path.join(self.application_directory(), self._filenames[self._source_type]))
+            cameras = virtual_cameras(self._cameras, units, self._delay, self._repeat)
+            print("Emulating %d cameras: %s" % (len(cameras), ", ".join(c.name for c in cameras)), flush=True)
+            self._virtual = VirtualCameras(cameras, self._frame_skip)
+            return
+
         # Generate the image iterator
         self._images = self.regen_iter()
         
@@ -53,6 +251,9 @@ class ImageSource(object):
                 with open(value.path, "rb") as f:
                     yield f.read()
     
+    def application_directory(self):
+        return self._app_dir if self._app_dir is not None else streamsx.ec.get_application_directory()
+
     def regen_iter(self):
         if self._repeat is None or self._repeat > 0:
             #print("Regenerating iterator")
@@ -60,17 +261,17 @@ class ImageSource(object):
                 self._repeat -= 1
             if self._source_type < 2:
                 # types 0 and 1 are MNIST sources, and the associated filename entry is the actual MNIST index filename
-                return self.mnist_postprocess(mnist_index_files.read_idx_units(os.path.join(streamsx.ec.get_application_directory(), self._filenames[self._source_type])))
+                return self.mnist_postprocess(mnist_index_files.read_idx_units(os.path.join(self.application_directory(), self._filenames[self._source_type])))
             else:
                 # types 2 and 3 are extra png file sources, and the associated filename entry is the directory to scan.
-                return self.extra_postprocess(os.scandir(os.path.join(streamsx.ec.get_application_directory(), self._filenames[self._source_type])))
+                return self.extra_postprocess(os.scandir(os.path.join(self.application_directory(), self._filenames[self._source_type])))
         else:
             print("Done repeating.  Camera exhausted.")
             raise StopIteration
         
     def __exit__(self, exc_type, exc_value, traceback):
         # __enter__ and __exit__ must both be defined.
-        pass    
+        operator_profiler.stop(self)
     
     def __call__(self):
         return self
@@ -79,19 +280,72 @@ class ImageSource(object):
         return self
     
     def __next__(self):
-        if self._delay is not None:
-            time.sleep(self._delay)
-        self._count += 1
-        
-        # Get the next image, either from the MNIST dataset or the next file in the directory
-        img = None
-        while img is None:
-            try:
-                img = next(self._images)                 
-            except StopIteration:
-                img = None
-                self._images = self.regen_iter()
+        if self._virtual is not None:
+            return next(self._virtual)
+        skipped = 0
+        while True:
+            if self._delay is not None:
+                time.sleep(self._delay)
+            self._count += 1
+
+            # Get the next image, either from the MNIST dataset or the next file in the directory
+            img = None
+            while img is None:
+                try:
+                    img = next(self._images)                 
+                except StopIteration:
+                    img = None
+                    self._images = self.regen_iter()
+
+            if skipped == self._frame_skip:
+                break
+            skipped += 1
 
         #print("Submitting new image", self._count)
-        return {'count': self._count, 'image': img}
-        
\ No newline at end of file
+        t = {'count': self._count, 'image': img}
+        if skipped > 0:
+            t['skipped'] = skipped
+        return t
+
+
+class Enricher(object):
+    """
+    Callable class that base64 encodes the image data, and adds some metadata to each tuple, including camera id/uid, timestamp, etc.
+
+    enrich_time is the same moment as timestamp, as epoch seconds: the start of the tuple's
+    age for the max_age load shedding in ImagePrep and DigitPredictor.
+    """
+
+    def __init__(self, get_camera_id):
+        # Note this method is only called when the topology is
+        # declared to create a instance to use in the map function.
+        self.get_camera_id = get_camera_id
+        self._uid = None
+        self._cam_name = None
+
+    def __call__(self, t):
+        t['image'] = base64.b64encode(t['image']).decode('utf-8')
+        if 'camera' in t:
+            # One of the virtual cameras of a multi-camera ImageSource
+            t['camera'] = self._cam_name + "-" + t['camera']
+        else:
+            t['camera'] = self._cam_name
+        now = time.time()
+        t['enrich_time'] = now
+        t['timestamp'] = datetime.datetime.utcfromtimestamp(now).isoformat() + 'Z'
+
+        return t
+
+    def __enter__(self):
+        # Called at runtime in the IBM Streams job before
+        # this instance starts processing tuples.
+        self._uid = socket.gethostname()
+        self._cam_name = self.get_camera_id() + "-" + self._uid
+        print("Camera name:", self._cam_name, flush=True)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # __enter__ and __exit__ must both be defined.
+        pass
+
+
+operator_profiler.register('ImageSource', ImageSource.__next__)
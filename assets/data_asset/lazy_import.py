@@ -0,0 +1,60 @@
+"""
+Deferred imports of heavy third-party packages, which load on first attribute access:
+
+    np = lazy_import.lazy_module('numpy')
+
+Not for the data_asset modules themselves: the topology only bundles modules it can see imported.
+"""
+import time
+import importlib
+import threading
+
+# Module name -> seconds spent importing it (including anything it imported in turn)
+import_times = {}
+
+_lock = threading.RLock()
+
+
+class LazyModule(object):
+    def __init__(self, name):
+        self.__dict__['_lazy_name'] = name
+        self.__dict__['_lazy_module'] = None
+
+    def _load(self):
+        with _lock:
+            module = self.__dict__['_lazy_module']
+            if module is None:
+                start_time = time.monotonic()
+                module = importlib.import_module(self.__dict__['_lazy_name'])
+                import_times[self.__dict__['_lazy_name']] = time.monotonic() - start_time
+                # Copy the module namespace, so later lookups are plain attribute hits
+                # that never come back through __getattr__.
+                self.__dict__.update(module.__dict__)
+                self.__dict__['_lazy_module'] = module
+        return module
+
+    def __getattr__(self, name):
+        # Only called for names not (yet) copied in, e.g. before the first load, or
+        # submodules imported after it.
+        return getattr(self._load(), name)
+
+    def __setattr__(self, name, value):
+        setattr(self._load(), name, value)
+
+    def __repr__(self):
+        return "<lazy module '%s'%s>" % (self.__dict__['_lazy_name'], '' if self.__dict__['_lazy_module'] is None else ' (loaded)')
+
+
+def lazy_module(name):
+    return LazyModule(name)
+
+
+def load(*modules):
+    """Force the given lazy modules to load now, e.g. during an operator's __enter__."""
+    for module in modules:
+        if isinstance(module, LazyModule):
+            module._load()
+
+
+def import_report():
+    return {'imports': dict(import_times), 'import_time': sum(import_times.values())}
@@ -1,19 +1,23 @@
 """
 Support for rendering views....
 """
-import matplotlib.pyplot as plt
-from matplotlib.pyplot import imshow
-import IPython
 import time
 import json
 import base64
 import io
 import collections
 import threading
-import pandas as pd
-import ipywidgets as widgets
-from ipywidgets.widgets.interaction import show_inline_matplotlib_plots
-from IPython.core.debugger import set_trace
+
+import lazy_import
+
+# The plotting and widget packages are only imported once a dashboard is built or drawn.
+plt = lazy_import.lazy_module('matplotlib.pyplot')
+IPython = lazy_import.lazy_module('IPython')
+pd = lazy_import.lazy_module('pandas')
+widgets = lazy_import.lazy_module('ipywidgets')
+interaction = lazy_import.lazy_module('ipywidgets.widgets.interaction')
+
+import model_training
 
 import urllib3
 urllib3.disable_warnings()
@@ -36,18 +40,20 @@ def display_digits():
 
 
 class view_to_queue():
-    def __init__(self, instance, view_name, output, max_deque=100):
+    def __init__(self, instance, view_name, output, max_deque=100, store=None):
         """move view elements to a queue in a thread
         
         - Spin up thread to read from the view.
         - tuples read goto deque,
-        - 
+        - tuples also appended to store, if one is given
         
         Args:
             instance: streams instance
             view_name : the name of the view 
             output: button rendering region
             max_deque : max number of tuples to hold in queue
+            store : optional uncertain_store.UncertainStore, keeps every tuple on disk
+                    for later paged review (store.pages(...) -> CorrectionDashboard.render_review)
         Notes:
             The queue elements are in tuples.
             ```
@@ -61,6 +67,7 @@ class view_to_queue():
         self.output = output
         self._view = instance.get_views(name=view_name)[0]
         self._view.start_data_fetch()
+        self.store = store
 
         # Thread to read from thread write to deque.
         self.tuples = collections.deque(maxlen=100)
@@ -76,6 +83,9 @@ class view_to_queue():
             if len(tups) > 0:
                 for tup in tups:
                     self.tuples.appendleft(tup)
+                if self.store is not None:
+                    self.store.extend(tups)
+                    self.store.flush()
             else: 
                 time.sleep(5)
 
@@ -134,7 +144,7 @@ class RenderClassificationMetrics:
                         df = pd.DataFrame({'uncertain counts': uncertain, 'certain counts': certain}, index=range(len(uncertain)))
                         ax = df.plot.bar(rot=0, title=camera)
                         ax.plot(figsize=[8, 1])
-                        show_inline_matplotlib_plots()     
+                        interaction.show_inline_matplotlib_plots()     
                 self.class_status_widget.value = "{} of {} ts: {}".format(cnt, len(view_metrics), metrics['timestamp'])
                 cnt += 1
                 time.sleep(2)
@@ -254,7 +264,7 @@ class RenderWindowUncertain:
                             ax = df.plot.bar(rot=0, title=camera)
                             ax.set_ylim(0,15)
                             time.sleep(.05)   
-                            show_inline_matplotlib_plots()
+                            interaction.show_inline_matplotlib_plots()
                     #if clear: self.graphic[camera]['output'].clear_output(wait=True)
                     clear = False
 
@@ -272,14 +282,17 @@ class RenderUncertainImages:
        This is for rendering, no fetching here.
        
     """
-    def __init__(self, output_uncertain= None, queue_depth=20):
+    def __init__(self, output_uncertain= None, queue_depth=20, duplicate_index=None):
         """Render data from 'UncertainPrediction' live and review
         
         Args:
             output_uncertain : output region dashboard will be displayed. 
             queue_depth : maximum number of elements that can be reviewed.
+            duplicate_index : optional duplicate_index.DuplicateIndex, near-duplicates of an
+                              image already shown only bump its count instead of being shown again.
         """
         self.output_uncertain = output_uncertain
+        self.duplicate_index = duplicate_index
         self.image_index = 0
         self.pause_active = False
         self.view_tuples = collections.deque(maxlen=queue_depth)
@@ -348,6 +361,12 @@ class RenderUncertainImages:
         """
         if self.pause_active:
             return
+        if self.duplicate_index is not None:
+            tup, new_cluster = self.duplicate_index.add(tup)
+            if not new_cluster:
+                self.status.value = "{} - similar to an earlier image (x{}), {} distinct of {}".format(
+                    status_text, tup['cluster_count'], len(self.duplicate_index), self.duplicate_index.received)
+                return
         self.view_tuples.appendleft(tup)
         self.render_view(tup, status_text)
         
@@ -364,6 +383,8 @@ class RenderUncertainImages:
           oimg = widgets.Image(value=io.BytesIO(base64.b64decode(ascImg)).getvalue(), width=300, height=400)
           self.camera.value = tup['camera']
           self.result.value = str(tup['result_class'])
+          if tup.get('cluster_count', 1) > 1:
+              self.result.value += " (x{})".format(tup['cluster_count'])
           for idx,x in enumerate(tup['predictions']):
                 self.digits[idx].value = "{:d}: {:3.2f}".format(idx, x)
                 self.digits[idx].layout = {'border': '2px solid green', 'height': '7%'} if tup['result_class'] == idx else {'height':'6%'}
@@ -371,7 +392,7 @@ class RenderUncertainImages:
                 
           self.status.value = status_text
           with self.prep:
-              imshow(prepImg, cmap=plt.cm.gray_r, interpolation='nearest')
+              plt.imshow(prepImg, cmap=plt.cm.gray_r, interpolation='nearest')
               plt.show()
                 
           with self.orig:
@@ -484,6 +505,9 @@ class CorrectionDashboard():
         """Setup event handler for Previous/Next/Commit buttons"""
         #set_trace()
         if button.description == "Training Upload":
+            if self.trainer is not None:
+                self.upload_corrections()
+                return
             image_new_result = [key for key in self.corrected_images.keys() if str(self.view_tuples[key]['result_class']) != self.corrected_images[key]]
             self.status.value = "Augment training for {} images".format(len(image_new_result))
             self.progress_rework.max = len(image_new_result)
@@ -504,10 +528,14 @@ class CorrectionDashboard():
         self.correct_radio.disabled = False
 
     
-    def __init__(self):
+    def __init__(self, trainer=None):
         """ Compose the dashboard images + controls.
 
+        Args:
+            trainer : optional model_training.IncrementalTrainer, "Training Upload" retrains
+                      the model with the corrections instead of simulating the upload.
         """
+        self.trainer = trainer
         self.corrected_images = collections.defaultdict(str)
         self.image_index = 1
         self.view_tuples = None
@@ -589,11 +617,13 @@ class CorrectionDashboard():
             self.prep.clear_output(wait=True)
             self.camera.value = tup['camera']
             self.result.value = "Model's prediction : {:d}".format(tup['result_class'])
+            if tup.get('cluster_count', 1) > 1:
+                self.result.value += " ({} similar images, corrected together)".format(tup['cluster_count'])
             self.status.value = status_text
             with self.orig:
                 stage.append_display_data(oimg)
             with self.prep:
-                imshow(prepImg, cmap=plt.cm.gray_r, interpolation='nearest')
+                plt.imshow(prepImg, cmap=plt.cm.gray_r, interpolation='nearest')
                 plt.show()
             radio_buttons = ['%d:%9.5f' % (idx, x) for idx, x in enumerate(tup['predictions'])] + ['Camera Error', '2nd Opinion', 'Not a Digit', 'Other']
             self.correct_radio.options = radio_buttons            
@@ -605,6 +635,23 @@ class CorrectionDashboard():
         except Exception as e:
             self.status.value = "Key error : {0:}".format(e)
 
+    def upload_corrections(self):
+        """Hand the corrected images to the trainer, progress is reported into the status line."""
+        images, labels = model_training.corrections_to_arrays(self.view_tuples, self.corrected_images)
+        if len(images) == 0:
+            self.status.value = "No digit corrections to train with"
+            return
+        self.status.value = "Augment training for {} images".format(len(images))
+        self.progress_rework.max = 3
+        self.progress_rework.value = 0
+
+        def progress(status, result):
+            self.progress_rework.value = min(self.progress_rework.value + 1, self.progress_rework.max)
+            if result is not None:
+                self.progress_rework.value = self.progress_rework.max
+            self.status.value = status
+        self.trainer.submit(images, labels, progress)
+
     def render_review(self, view_tuples):
         self.view_tuples = view_tuples
         self.image_index = 0
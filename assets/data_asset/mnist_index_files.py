@@ -1,6 +1,11 @@
 import numpy as np
-from PIL import Image, ImageOps
 import io
+import os
+
+import lazy_import
+
+Image = lazy_import.lazy_module('PIL.Image')
+ImageOps = lazy_import.lazy_module('PIL.ImageOps')
 
 # Training and test data set files, all labeled
 FN_TEST_LABELS = 'data/mnist/t10k-labels-idx1-ubyte'
@@ -92,4 +97,149 @@ def to_filehandle(image):
     of.seek(0)
     return of
     
-    
\ No newline at end of file
+    
+
+# Helper maps between numpy dtypes and the IDX type enum values, used by the writers below.
+IDX_TYPE_CODES = {np.dtype('>u1'): 8, np.dtype('>i1'): 9, np.dtype('>i2'): 0xb, np.dtype('>i4'): 0xc, np.dtype('>f4'): 0xd, np.dtype('>f8'): 0xe}
+IDX_DTYPES = {code: dtype for dtype, code in IDX_TYPE_CODES.items()}
+
+
+# Parse the header of an open IDX file, leaving the file positioned at the start of the data.
+# Returns the numpy dtype and the list of dimension sizes.
+def read_idx_header(f):
+    zero, = np.fromfile(f, dtype='>u2', count=1)
+    dte, dims = np.fromfile(f, dtype='>u1', count=2)
+    if zero != 0 or dte not in IDX_DTYPES:
+        raise ValueError("Not an IDX file: %s" % (getattr(f, 'name', f),))
+    return IDX_DTYPES[dte], [int(d) for d in np.fromfile(f, dtype='>u4', count=dims)]
+
+
+# Random access to the units of an IDX file: reader[i] is unit i (see read_idx_units).
+# The data is memory-mapped, so one reader can be shared by any number of consumers
+# (e.g. the virtual cameras of an ImageSource), and only the pages used are read.
+class IdxReader(object):
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename, 'rb') as f:
+            self.dtype, self.shape = read_idx_header(f)
+            offset = f.tell()
+        self.units = np.memmap(filename, dtype=self.dtype, mode='r', offset=offset, shape=tuple(self.shape))
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, index):
+        return np.array(self.units[index])
+
+
+# Streams units (see read_idx_units) into an IDX file, one or a batch at a time, without
+# holding the data set in memory.  The dimension-0 count in the header is only known once
+# all the units are written, so it is fixed up on close().
+# With append=True, an existing file is extended instead; its dtype and unit shape must match.
+# Use as a context manager, or call close() explicitly, otherwise the header count is not updated.
+class IdxWriter(object):
+    def __init__(self, filename, dtype='>u1', unit_shape=(), append=False):
+        self.filename = filename
+        self.dtype = np.dtype(dtype).newbyteorder('>')
+        self.unit_shape = tuple(int(d) for d in unit_shape)
+        if self.dtype not in IDX_TYPE_CODES:
+            raise ValueError("Unsupported IDX dtype: %s" % (dtype,))
+        self.unit_size = int(np.prod(self.unit_shape)) if len(self.unit_shape) > 0 else 1
+
+        if append and os.path.exists(filename):
+            self._f = open(filename, 'r+b')
+            file_dtype, dsizes = read_idx_header(self._f)
+            if file_dtype != self.dtype or tuple(dsizes[1:]) != self.unit_shape:
+                self._f.close()
+                raise ValueError("Cannot append %s%s units to %s, which holds %s%s units" % (self.dtype, self.unit_shape, filename, file_dtype, tuple(dsizes[1:])))
+            self._data_start = self._f.tell()
+            self.count = dsizes[0]
+            # Drop anything past the last complete unit, e.g. left over from an interrupted writer
+            self._f.seek(self._data_start + self.count * self.unit_size * self.dtype.itemsize)
+            self._f.truncate()
+        else:
+            self._f = open(filename, 'wb')
+            self._f.write(bytes([0, 0, IDX_TYPE_CODES[self.dtype], len(self.unit_shape) + 1]))
+            np.array((0,) + self.unit_shape, dtype='>u4').tofile(self._f)
+            self._data_start = self._f.tell()
+            self.count = 0
+
+    # Write a single unit, which must have the writer's unit shape (a scalar, for rank-1 files)
+    def write(self, unit):
+        unit = np.asarray(unit)
+        if unit.shape != self.unit_shape:
+            raise ValueError("Unit shape %s does not match %s" % (unit.shape, self.unit_shape))
+        self._f.write(unit.astype(self.dtype, copy=False).tobytes(order='C'))
+        self.count += 1
+
+    # Write a batch of units, stacked along a new first dimension
+    def write_units(self, units):
+        units = np.asarray(units)
+        if units.shape[1:] != self.unit_shape:
+            raise ValueError("Unit shape %s does not match %s" % (units.shape[1:], self.unit_shape))
+        self._f.write(units.astype(self.dtype, copy=False).tobytes(order='C'))
+        self.count += len(units)
+
+    def flush(self):
+        self._write_count()
+        self._f.flush()
+
+    def _write_count(self):
+        end = self._f.tell()
+        self._f.seek(4)
+        np.array([self.count], dtype='>u4').tofile(self._f)
+        self._f.seek(end)
+
+    def close(self):
+        if not self._f.closed:
+            self._write_count()
+            self._f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+# Writes an image file and its label file as a matched pair, like the MNIST train/t10k files,
+# so the two always hold the same number of units.
+class IdxPairWriter(object):
+    def __init__(self, images_filename, labels_filename, image_shape=(28, 28), append=False):
+        self.images = IdxWriter(images_filename, dtype='>u1', unit_shape=image_shape, append=append)
+        try:
+            self.labels = IdxWriter(labels_filename, dtype='>u1', unit_shape=(), append=append)
+        except Exception:
+            self.images.close()
+            raise
+        if self.images.count != self.labels.count:
+            self.close()
+            raise ValueError("%s holds %d images but %s holds %d labels" % (images_filename, self.images.count, labels_filename, self.labels.count))
+
+    @property
+    def count(self):
+        return self.images.count
+
+    def write(self, image, label):
+        self.images.write(image)
+        self.labels.write(label)
+
+    def write_units(self, images, labels):
+        if len(images) != len(labels):
+            raise ValueError("%d images but %d labels" % (len(images), len(labels)))
+        self.images.write_units(images)
+        self.labels.write_units(labels)
+
+    def flush(self):
+        self.images.flush()
+        self.labels.flush()
+
+    def close(self):
+        self.images.close()
+        self.labels.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -0,0 +1,151 @@
+"""
+Offline, bulk evaluation of the digit model through the same preprocessing as ImageSource
+and ImagePrep at the edge: accuracy, confusion matrix, expected send-home rate and images/sec.
+
+    python model_evaluation.py HandwrittenDigits_Model --data-dir /project_data/data_asset
+    python model_evaluation.py HandwrittenDigits_Model --png-dir labelled-images/
+"""
+import io
+import os
+import time
+import argparse
+
+import numpy as np
+import joblib
+from PIL import Image
+
+import image_processing
+import mnist_index_files
+
+# Histogram bins for result_probability
+PROBABILITY_BINS = np.linspace(0.0, 1.0, 21)
+
+
+# Labelled IDX images, as PNG blobs just like ImageSource produces them, in chunks of
+# (list of PNG bytes, labels array).
+def idx_chunks(images_fn, labels_fn, chunk_size=1000, count=None):
+    labels = mnist_index_files.read_idx_file(labels_fn, count=count)
+    images = mnist_index_files.read_idx_units(images_fn, count=count)
+    for start in range(0, len(labels), chunk_size):
+        blobs = []
+        for image in images:
+            with mnist_index_files.to_filehandle(image) as f:
+                blobs.append(f.read())
+            if len(blobs) == chunk_size:
+                break
+        yield blobs, labels[start:start + len(blobs)]
+
+
+# Labelled PNG files, either in one subdirectory per digit (<dir>/3/foo.png) or named with
+# the digit first (<dir>/3_foo.png), in chunks of (list of PNG bytes, labels array).
+def png_chunks(directory, chunk_size=1000, count=None):
+    entries = []
+    for root, dirs, files in os.walk(directory):
+        dirs.sort()
+        parent = os.path.basename(root)
+        for name in sorted(files):
+            if not name.endswith('.png'):
+                continue
+            if parent.isdigit() and len(parent) == 1:
+                entries.append((os.path.join(root, name), int(parent)))
+            elif name[0].isdigit():
+                entries.append((os.path.join(root, name), int(name[0])))
+    entries = entries[:count]
+    for start in range(0, len(entries), chunk_size):
+        blobs = []
+        for path, label in entries[start:start + chunk_size]:
+            with open(path, 'rb') as f:
+                blobs.append(f.read())
+        yield blobs, np.array([label for path, label in entries[start:start + chunk_size]], dtype=np.uint8)
+
+
+# The ImagePrep steps for a chunk of PNG blobs: the PIL steps per image, then centering by
+# pixel mass for the whole chunk at once.  Returns (N, 28, 28) uint8.
+def prepare_chunk(blobs):
+    resized = np.empty((len(blobs), 20, 20), dtype=np.uint8)
+    for idx, blob in enumerate(blobs):
+        with io.BytesIO(blob) as f:
+            with Image.open(f) as image:
+                resized[idx] = np.array(image_processing.square_fit_resize(image_processing.file_loaded_preprep(image)))
+    return image_processing.batch_center_by_pixel_mass(resized)
+
+
+def evaluate_model(clf, chunks, confidence=0.70, predict_chunk_size=1000):
+    """Prepare and score every chunk, returning the evaluation report as a dict."""
+    confusion = np.zeros((10, 10), dtype=np.int64)
+    probability_counts = np.zeros(len(PROBABILITY_BINS) - 1, dtype=np.int64)
+    uncertain = 0
+    uncertain_wrong = 0
+    total = 0
+    prep_time = 0.0
+    predict_time = 0.0
+    start_time = time.monotonic()
+    for blobs, labels in chunks:
+        t0 = time.monotonic()
+        prepared = prepare_chunk(blobs).reshape(len(blobs), -1)
+        t1 = time.monotonic()
+        probabilities = np.concatenate([clf.predict_proba(prepared[start:start + predict_chunk_size])
+                                        for start in range(0, len(prepared), predict_chunk_size)])
+        predict_time += time.monotonic() - t1
+        prep_time += t1 - t0
+
+        result_class = probabilities.argmax(axis=1)
+        result_probability = probabilities[np.arange(len(probabilities)), result_class]
+        confusion += np.bincount(labels.astype(np.int64) * 10 + result_class, minlength=100).reshape(10, 10)
+        probability_counts += np.histogram(result_probability, bins=PROBABILITY_BINS)[0]
+        # Same test as the edge CertaintyFilter
+        is_uncertain = result_probability <= confidence
+        uncertain += int(is_uncertain.sum())
+        uncertain_wrong += int((is_uncertain & (result_class != labels)).sum())
+        total += len(labels)
+    elapsed = time.monotonic() - start_time
+
+    correct = int(np.trace(confusion))
+    return {'images': total,
+            'accuracy': correct / total if total else 0.0,
+            'confusion_matrix': confusion.tolist(),
+            'confidence': confidence,
+            'uncertain_rate': uncertain / total if total else 0.0,
+            'uncertain_error_rate': uncertain_wrong / uncertain if uncertain else 0.0,
+            'certain_accuracy': (correct - (uncertain - uncertain_wrong)) / (total - uncertain) if total > uncertain else 0.0,
+            'probability_histogram': {'bins': PROBABILITY_BINS.tolist(), 'counts': probability_counts.tolist()},
+            'prep_rate': total / prep_time if prep_time > 0 else 0.0,
+            'predict_rate': total / predict_time if predict_time > 0 else 0.0,
+            'images_per_sec': total / elapsed if elapsed > 0 else 0.0}
+
+
+def print_report(report):
+    print("Images:               %d" % report['images'])
+    print("Accuracy:             %.4f" % report['accuracy'])
+    print("Uncertain (<= %.2f):   %.4f of images, %.4f of those wrong" % (report['confidence'], report['uncertain_rate'], report['uncertain_error_rate']))
+    print("Certain accuracy:     %.4f" % report['certain_accuracy'])
+    print("Throughput:           %.1f img/s overall, prep %.1f img/s, predict %.1f img/s" % (report['images_per_sec'], report['prep_rate'], report['predict_rate']))
+    print("Confusion matrix (rows: label, columns: predicted):")
+    for label, row in enumerate(report['confusion_matrix']):
+        print("  %d: %s" % (label, " ".join("%5d" % c for c in row)))
+    print("result_probability distribution:")
+    bins = report['probability_histogram']['bins']
+    for lo, hi, count in zip(bins[:-1], bins[1:], report['probability_histogram']['counts']):
+        marker = " <- uncertain" if hi <= report['confidence'] + 1e-9 else ""
+        print("  %.2f-%.2f: %6d%s" % (lo, hi, count, marker))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Evaluate the digit model through the edge preprocessing path")
+    parser.add_argument('model', help="model file (e.g. HandwrittenDigits_Model)")
+    parser.add_argument('--data-dir', default='.', help="directory the data/mnist IDX files are under")
+    parser.add_argument('--train', action='store_true', help="evaluate on the train IDX files instead of t10k")
+    parser.add_argument('--png-dir', default=None, help="evaluate labelled PNGs instead of IDX files")
+    parser.add_argument('--count', type=int, default=None, help="only evaluate the first COUNT images")
+    parser.add_argument('--chunk-size', type=int, default=1000)
+    parser.add_argument('--confidence', type=float, default=0.70)
+    args = parser.parse_args()
+
+    if args.png_dir is not None:
+        chunks = png_chunks(args.png_dir, chunk_size=args.chunk_size, count=args.count)
+    else:
+        images_fn, labels_fn = ((mnist_index_files.FN_TRAIN_IMAGES, mnist_index_files.FN_TRAIN_LABELS) if args.train
+                                else (mnist_index_files.FN_TEST_IMAGES, mnist_index_files.FN_TEST_LABELS))
+        chunks = idx_chunks(os.path.join(args.data_dir, images_fn), os.path.join(args.data_dir, labels_fn),
+                            chunk_size=args.chunk_size, count=args.count)
+    print_report(evaluate_model(joblib.load(args.model), chunks, confidence=args.confidence, predict_chunk_size=args.chunk_size))
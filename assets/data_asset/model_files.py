@@ -0,0 +1,27 @@
+"""
+Versioned model files, shared by the metro-side trainer (model_training) and the edge
+DigitPredictor, so neither has to import the other's dependencies.
+"""
+import os
+import re
+
+# Versioned models are written alongside the original, as <model>-v2, <model>-v3, ...
+VERSION_PATTERN = re.compile(r'-v(\d+)$')
+
+
+# The model versions present for a base model path, as a sorted list of (version, path).
+# The base model itself is version 1.
+def model_versions(model_path):
+    versions = [(1, model_path)] if os.path.exists(model_path) else []
+    directory, base = os.path.split(model_path)
+    for name in os.listdir(directory or '.'):
+        if name.startswith(base + '-v'):
+            match = VERSION_PATTERN.search(name)
+            if match:
+                versions.append((int(match.group(1)), os.path.join(directory, name)))
+    return sorted(versions)
+
+
+def latest_model(model_path):
+    versions = model_versions(model_path)
+    return versions[-1] if versions else (None, None)
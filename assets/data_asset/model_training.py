@@ -0,0 +1,222 @@
+"""
+Incremental retraining of the digit model from the CorrectionDashboard's corrections.
+"""
+import os
+import re
+import time
+import queue
+import threading
+
+import numpy as np
+
+import lazy_import
+import mnist_index_files
+from model_files import model_versions, latest_model
+
+joblib = lazy_import.lazy_module('joblib')
+
+# Radio button labels in the CorrectionDashboard look like '3:  0.41237' (or plain '3' before
+# the first image is displayed).  Anything else ('Camera Error', 'Not a Digit'...) is not training data.
+LABEL_PATTERN = re.compile(r'^\s*(\d)(:|$)')
+
+def correction_label(radio_value):
+    match = LABEL_PATTERN.match(radio_value)
+    return int(match.group(1)) if match else None
+
+
+# Gather the prepared images and manually assigned digits from a correction session,
+# as (N, 784) and (N,) arrays in the same layout as the MNIST IDX data.
+# A cluster representative (see duplicate_index) carries its members' images, and the
+# correction applies to all of them.
+def corrections_to_arrays(view_tuples, corrected_images):
+    images = []
+    labels = []
+    for idx, radio_value in corrected_images.items():
+        label = correction_label(radio_value)
+        if label is None:
+            continue
+        tup = view_tuples[idx]
+        if 'cluster_images' in tup:
+            member_images = np.asarray(tup['cluster_images'], dtype=np.uint8).reshape(-1, 28 * 28)
+        else:
+            member_images = np.asarray(tup['prepared_image'], dtype=np.uint8).reshape(1, -1)
+        images.extend(member_images)
+        labels.extend([label] * len(member_images))
+    return np.array(images, dtype=np.uint8).reshape(-1, 28 * 28), np.array(labels, dtype=np.uint8)
+
+
+# Load an IDX image/label file pair as (N, 784) uint8 images and (N,) labels
+def load_idx_dataset(images_fn, labels_fn, start=0, count=None):
+    images = mnist_index_files.read_idx_file(images_fn, start=start, count=count)
+    labels = mnist_index_files.read_idx_file(labels_fn, start=start, count=count)
+    return images.reshape(len(images), -1), labels
+
+
+# Score a model over a whole dataset, in chunks so memory stays bounded for large sets.
+def evaluate(clf, images, labels, chunk_size=2000):
+    start_time = time.monotonic()
+    correct = 0
+    for start in range(0, len(images), chunk_size):
+        predicted = clf.predict(images[start:start + chunk_size])
+        correct += int(np.count_nonzero(predicted == labels[start:start + chunk_size]))
+    return correct / max(len(images), 1), time.monotonic() - start_time
+
+
+class IncrementalTrainer(object):
+    """Background worker that folds corrected images into the digit model, and writes a new
+    versioned model only when its t10k accuracy did not regress.
+
+    Args:
+        model_path: path of the base model file (e.g. the HandwrittenDigits_Model data asset).
+        data_dir: directory holding the MNIST train and t10k IDX pairs, either under the
+                  mnist_index_files FN_* relative paths or directly (e.g. as uploaded data assets).
+        replay_count: number of MNIST train images mixed in with each batch of corrections,
+                      so the update does not forget what the model already knows.
+        correction_weight: how many times each corrected image is repeated in the update set.
+        extra_estimators: trees added per update for warm-start ensembles (e.g. RandomForest).
+        tolerance: accuracy drop on t10k that is still accepted as "not a regression".
+        corrections_prefix: if given, every corrected batch is also appended to the IDX pair
+                            <prefix>-images-idx3-ubyte / <prefix>-labels-idx1-ubyte, for later full retrains.
+    """
+    def __init__(self, model_path, data_dir='.', replay_count=5000, correction_weight=10,
+                 extra_estimators=10, tolerance=0.0, batch_size=1000, corrections_prefix=None):
+        self.model_path = model_path
+        self.data_dir = data_dir
+        self.replay_count = replay_count
+        self.correction_weight = correction_weight
+        self.extra_estimators = extra_estimators
+        self.tolerance = tolerance
+        self.batch_size = batch_size
+        self.corrections_prefix = corrections_prefix
+
+        # Fail here rather than on the first submit, inside the worker thread
+        self._files = {fn: self._find(fn) for fn in (mnist_index_files.FN_TRAIN_IMAGES, mnist_index_files.FN_TRAIN_LABELS,
+                                                     mnist_index_files.FN_TEST_IMAGES, mnist_index_files.FN_TEST_LABELS)}
+        missing = [os.path.basename(fn) for fn, path in self._files.items() if path is None]
+        if missing:
+            raise FileNotFoundError("IncrementalTrainer needs the MNIST IDX files {} in {}".format(", ".join(missing), data_dir))
+
+        self._requests = queue.Queue()
+        self._thread = None
+        self._train = None
+        self._test = None
+        self._baseline = None
+        self.history = []
+
+    def _find(self, fn):
+        for path in (os.path.join(self.data_dir, fn), os.path.join(self.data_dir, os.path.basename(fn))):
+            if os.path.exists(path):
+                return path
+        return None
+
+    def _dataset(self, images_fn, labels_fn):
+        return load_idx_dataset(self._files[images_fn], self._files[labels_fn])
+
+    def start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name="IncrementalTrainer", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._requests.put(None)
+
+    def submit(self, images, labels, callback=None):
+        """Queue a batch of corrected (N, 784) images and their labels for training.
+
+        callback(status: str, result: dict or None) is called from the worker thread as the
+        update progresses, and finally with the result dict (see update()).
+        """
+        self.start()
+        self._requests.put((images, labels, callback))
+
+    def _run(self):
+        while True:
+            request = self._requests.get()
+            if request is None:
+                return
+            images, labels, callback = request
+            notify = callback if callback is not None else (lambda status, result: None)
+            try:
+                result = self.update(images, labels, notify)
+                notify(self.describe(result), result)
+            except Exception as e:
+                notify("Training failed: {}".format(e), None)
+
+    def update(self, images, labels, notify=lambda status, result: None):
+        """Train on the corrections synchronously, returning a dict describing the outcome."""
+        if self.corrections_prefix is not None:
+            self.save_corrections(images, labels)
+        if self._train is None:
+            notify("Loading MNIST training/test sets", None)
+            self._train = self._dataset(mnist_index_files.FN_TRAIN_IMAGES, mnist_index_files.FN_TRAIN_LABELS)
+            self._test = self._dataset(mnist_index_files.FN_TEST_IMAGES, mnist_index_files.FN_TEST_LABELS)
+
+        version, current_path = latest_model(self.model_path)
+        clf = joblib.load(current_path)
+        if self._baseline is None or self._baseline[0] != version:
+            notify("Evaluating current model v{}".format(version), None)
+            self._baseline = (version,) + evaluate(clf, *self._test)
+
+        # Mix the corrections (repeated, so a handful of images still carry weight) with a
+        # random replay sample of the original training set.
+        replay = np.random.choice(len(self._train[0]), size=min(self.replay_count, len(self._train[0])), replace=False)
+        x = np.concatenate([self._train[0][replay]] + [images] * self.correction_weight)
+        y = np.concatenate([self._train[1][replay]] + [labels] * self.correction_weight)
+        shuffle = np.random.permutation(len(x))
+        x, y = x[shuffle], y[shuffle]
+
+        notify("Training on {} corrected + {} replayed images".format(len(images), len(replay)), None)
+        start_time = time.monotonic()
+        # Update in place where the estimator allows it (SGD, MLP, naive Bayes), else refit from
+        # its current state with warm_start; a full retrain does not belong in the notebook.
+        if hasattr(clf, 'partial_fit'):
+            classes = np.arange(10)
+            for start in range(0, len(x), self.batch_size):
+                clf.partial_fit(x[start:start + self.batch_size], y[start:start + self.batch_size], classes=classes)
+        elif 'warm_start' in clf.get_params():
+            params = {'warm_start': True}
+            if 'n_estimators' in clf.get_params():
+                params['n_estimators'] = clf.get_params()['n_estimators'] + self.extra_estimators
+            clf.set_params(**params)
+            clf.fit(x, y)
+        else:
+            raise ValueError("{} supports neither partial_fit nor warm_start".format(type(clf).__name__))
+        train_time = time.monotonic() - start_time
+
+        notify("Evaluating updated model", None)
+        accuracy, eval_time = evaluate(clf, *self._test)
+        result = {'base_version': version,
+                  'base_accuracy': self._baseline[1],
+                  'accuracy': accuracy,
+                  'corrected_images': len(images),
+                  'train_images': len(x),
+                  'train_time': train_time,
+                  'train_rate': len(x) / train_time if train_time > 0 else float('inf'),
+                  'eval_images': len(self._test[0]),
+                  'eval_time': eval_time,
+                  'eval_rate': len(self._test[0]) / eval_time if eval_time > 0 else float('inf'),
+                  'version': None,
+                  'model_path': None}
+        if accuracy >= self._baseline[1] - self.tolerance:
+            result['version'] = version + 1
+            result['model_path'] = "{}-v{}".format(self.model_path, version + 1)
+            # Written under a name model_versions() ignores and then renamed, so a watcher
+            # polling for -v<N> files never loads a partly written model
+            joblib.dump(clf, result['model_path'] + '.tmp')
+            os.replace(result['model_path'] + '.tmp', result['model_path'])
+            self._baseline = (version + 1, accuracy, eval_time)
+        self.history.append(result)
+        return result
+
+    def save_corrections(self, images, labels):
+        with mnist_index_files.IdxPairWriter(self.corrections_prefix + '-images-idx3-ubyte',
+                                             self.corrections_prefix + '-labels-idx1-ubyte',
+                                             append=True) as writer:
+            writer.write_units(np.asarray(images, dtype=np.uint8).reshape(-1, 28, 28), labels)
+
+    @staticmethod
+    def describe(result):
+        rates = "trained {train_images} imgs at {train_rate:.0f} img/s, evaluated {eval_images} in {eval_time:.2f}s".format(**result)
+        if result['version'] is None:
+            return "Kept v{base_version}: accuracy {accuracy:.4f} < {base_accuracy:.4f}; ".format(**result) + rates
+        return "Saved v{version}: accuracy {base_accuracy:.4f} -> {accuracy:.4f}; ".format(**result) + rates
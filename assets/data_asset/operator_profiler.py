@@ -0,0 +1,167 @@
+"""
+Sampling profiler for the edge operators: a background thread per process samples every
+thread's stack and counts those inside a registered operator, written as collapsed stacks
+for flamegraph.pl or speedscope:
+
+    ImagePrep;__call__ (image_classifier.py:225);file_loaded_preprep (image_processing.py:12) 131
+"""
+import os
+import sys
+import time
+import socket
+import datetime
+import threading
+import collections
+
+# code object -> operator name
+_targets = {}
+
+_profiler = None
+# Owners (operators) that started the profiler and have not stopped it yet
+_owners = set()
+_lock = threading.Lock()
+
+
+def register(name, function):
+    """Attribute samples inside function (e.g. ImagePrep.__call__) to operator name."""
+    _targets[function.__code__] = name
+
+
+class SamplingProfiler(object):
+    """Background stack sampler for the registered operators.
+
+    Args:
+        rate: samples per second.
+        directory: where the collapsed stack file is written, None for no file.
+        interval: seconds between writes.
+        max_overhead: largest fraction of wall time the sampler may use.
+        max_depth: deepest stack followed while looking for an operator frame.
+        publish: optional callable given each profile as a dict, as a side channel.
+    """
+    def __init__(self, rate, directory=None, interval=30.0, max_overhead=0.02, max_depth=128, publish=None):
+        self.rate = float(rate)
+        self.directory = directory
+        self.interval = interval
+        self.max_overhead = max_overhead
+        self.max_depth = max_depth
+        self.publish = publish
+        self.path = None
+        if directory is not None:
+            self.path = os.path.join(directory, "profile-%s-%d.collapsed" % (socket.gethostname(), os.getpid()))
+        self.counts = collections.Counter()
+        self.samples = 0
+        self.sample_time = 0.0
+        self._labels = {}
+        self._stop = None
+        self._thread = None
+        self._start_time = None
+        self._elapsed = 0.0
+
+    def _label(self, code):
+        label = self._labels.get(code)
+        if label is None:
+            label = self._labels[code] = "%s (%s:%d)" % (code.co_name, os.path.basename(code.co_filename), code.co_firstlineno)
+        return label
+
+    def sample(self):
+        """Take one sample of every thread, counting the stacks inside an operator."""
+        own = threading.get_ident()
+        for ident, frame in sys._current_frames().items():
+            if ident == own:
+                continue
+            stack = []
+            while frame is not None and len(stack) < self.max_depth:
+                stack.append(frame.f_code)
+                name = _targets.get(frame.f_code)
+                if name is not None:
+                    self.counts[(name,) + tuple(self._label(code) for code in reversed(stack))] += 1
+                    break
+                frame = frame.f_back
+        self.samples += 1
+
+    def collapsed(self):
+        return "".join("%s %d\n" % (";".join(stack), count) for stack, count in sorted(self.counts.items()))
+
+    def write(self):
+        text = self.collapsed()
+        elapsed = self._elapsed + (time.monotonic() - self._start_time if self._thread is not None else 0.0)
+        # All counts since the first start, replaced atomically so the file can be copied at any time
+        if self.path is not None:
+            with open(self.path + '.tmp', 'w') as f:
+                f.write(text)
+            os.replace(self.path + '.tmp', self.path)
+        if self.publish is not None:
+            self.publish({'profile': text,
+                          'host': socket.gethostname(),
+                          'pid': os.getpid(),
+                          'samples': self.samples,
+                          'overhead': self.sample_time / elapsed if elapsed > 0 else 0.0,
+                          'timestamp': datetime.datetime.utcnow().isoformat() + 'Z'})
+        print("Profiler: %d samples in %.0fs (%.1f/s), %.2f%% overhead%s" % (
+              self.samples, elapsed, self.samples / elapsed if elapsed > 0 else 0.0,
+              100.0 * self.sample_time / elapsed if elapsed > 0 else 0.0,
+              ", written to " + self.path if self.path is not None else ""), flush=True)
+
+    def _run(self):
+        period = 1.0 / self.rate
+        next_write = time.monotonic() + self.interval
+        while not self._stop.wait(period):
+            start_time = time.monotonic()
+            self.sample()
+            cost = time.monotonic() - start_time
+            self.sample_time += cost
+            # Sampling cost / period <= max_overhead
+            period = max(1.0 / self.rate, cost / self.max_overhead)
+            if time.monotonic() >= next_write:
+                self.write()
+                next_write = time.monotonic() + self.interval
+
+    def start(self):
+        """Start sampling, or resume it after stop(), adding to the counts so far."""
+        if self._thread is not None:
+            return
+        self._start_time = time.monotonic()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="OperatorProfiler", daemon=True)
+        self._thread.start()
+        print("Profiler sampling at %.1f/s for: %s" % (self.rate, ", ".join(sorted(set(_targets.values())))), flush=True)
+
+    def stop(self):
+        """Stop sampling and write the profile."""
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._elapsed += time.monotonic() - self._start_time
+        self._thread = None
+        self.write()
+
+
+# Start (or resume) this process's profiler for owner if rate (or a submission parameter
+# callable) is above 0, returning it, or None if profiling is off.  Starting again for the
+# same owner does nothing more; rate and directory are taken from the first start.
+def start(rate, directory=None, owner=None, **kwargs):
+    global _profiler
+    if callable(rate):
+        rate = rate()
+    if not rate or float(rate) <= 0:
+        return None
+    with _lock:
+        if _profiler is None:
+            if callable(directory):
+                directory = directory()
+            _profiler = SamplingProfiler(rate, directory if directory else os.getcwd(), **kwargs)
+        _owners.add(owner)
+        _profiler.start()
+        return _profiler
+
+
+# Release owner's start(); the last owner to stop stops sampling and writes the profile.
+# Owners that did not start it (e.g. profiling off) are ignored.
+def stop(owner=None):
+    with _lock:
+        if owner not in _owners:
+            return
+        _owners.discard(owner)
+        if len(_owners) == 0:
+            _profiler.stop()
@@ -0,0 +1,302 @@
+"""
+Append-only, memory-mappable store for 'UncertainPredictions' tuples.
+"""
+import os
+import json
+import base64
+import datetime
+import threading
+from array import array
+
+import numpy as np
+
+RECORD_DTYPE = np.dtype([('timestamp', '<f8'),
+                         ('count', '<i8'),
+                         ('blob_offset', '<u8'),
+                         ('blob_length', '<u4'),
+                         ('camera', '<u4'),
+                         ('result_probability', '<f4'),
+                         ('result_class', 'u1'),
+                         ('band', 'u1')])
+
+IMAGE_SHAPE = (28, 28)
+NUM_CLASSES = 10
+
+# Upper edges of the confidence bands, so band 0 is [0, 0.3), band 1 is [0.3, 0.5), etc.
+# Anything at or above the last edge lands in the final band.
+DEFAULT_BANDS = (0.3, 0.5, 0.7, 0.9)
+
+# One file per column, appended in lock-step.  records.bin is written last, so its length is
+# the committed row count; anything past it in the others (an interrupted append) is trimmed on open.
+FN_RECORDS = 'records.bin'      # RECORD_DTYPE rows
+FN_PREPARED = 'prepared.u1'     # N x 28 x 28 prepared images
+FN_SCORES = 'scores.f4'         # N x 10 predictions
+FN_BLOBS = 'blobs.bin'          # original images, back to back
+FN_CAMERAS = 'cameras.json'     # camera name table
+
+
+# The edge stamps tuples with datetime.utcnow().isoformat() + 'Z', which drops the
+# fractional part when it happens to be zero.
+def parse_timestamp(ts):
+    ts = ts.rstrip('Z')
+    fmt = '%Y-%m-%dT%H:%M:%S.%f' if '.' in ts else '%Y-%m-%dT%H:%M:%S'
+    dt = datetime.datetime.strptime(ts, fmt)
+    return (dt - datetime.datetime(1970, 1, 1)).total_seconds()
+
+
+def format_timestamp(seconds):
+    return (datetime.datetime(1970, 1, 1) + datetime.timedelta(seconds=float(seconds))).isoformat() + 'Z'
+
+
+class UncertainStore(object):
+    """Indexed on-disk store of uncertain predictions.
+
+    Args:
+        path: directory holding the store, created if it does not exist.
+        bands: upper edges of the confidence bands used by the band index.
+    """
+    def __init__(self, path, bands=DEFAULT_BANDS):
+        self.path = path
+        self.bands = np.array(bands, dtype='<f4')
+        # A view_to_queue fetch thread may append while a dashboard queries
+        self._lock = threading.RLock()
+        os.makedirs(path, exist_ok=True)
+
+        cameras_fn = os.path.join(path, FN_CAMERAS)
+        if os.path.exists(cameras_fn):
+            with open(cameras_fn) as f:
+                self.cameras = json.load(f)
+        else:
+            self.cameras = []
+        self._camera_ids = {name: idx for idx, name in enumerate(self.cameras)}
+
+        self._size = os.path.getsize(self._fn(FN_RECORDS)) // RECORD_DTYPE.itemsize if os.path.exists(self._fn(FN_RECORDS)) else 0
+        self._recover()
+        self._maps = None
+        self._time_order = None
+        self._build_indexes()
+
+        self._records_f = open(self._fn(FN_RECORDS), 'ab')
+        self._prepared_f = open(self._fn(FN_PREPARED), 'ab')
+        self._scores_f = open(self._fn(FN_SCORES), 'ab')
+        self._blobs_f = open(self._fn(FN_BLOBS), 'ab')
+
+    def _fn(self, name):
+        return os.path.join(self.path, name)
+
+    def _recover(self):
+        """Trim every column back to the committed row count."""
+        records_fn = self._fn(FN_RECORDS)
+        if not os.path.exists(records_fn):
+            open(records_fn, 'wb').close()
+        os.truncate(records_fn, self._size * RECORD_DTYPE.itemsize)
+        blob_end = 0
+        if self._size > 0:
+            last = np.memmap(records_fn, dtype=RECORD_DTYPE, mode='r', offset=(self._size - 1) * RECORD_DTYPE.itemsize, shape=(1,))[0]
+            blob_end = int(last['blob_offset']) + int(last['blob_length'])
+        for name, unit in ((FN_PREPARED, int(np.prod(IMAGE_SHAPE))), (FN_SCORES, NUM_CLASSES * 4), (FN_BLOBS, None)):
+            fn = self._fn(name)
+            if not os.path.exists(fn):
+                open(fn, 'wb').close()
+            os.truncate(fn, blob_end if unit is None else self._size * unit)
+
+    # Posting lists of row numbers per camera, class and band, kept in memory and rebuilt on open
+    def _build_indexes(self):
+        self._by_camera = {}
+        self._by_class = {}
+        self._by_band = {}
+        if self._size == 0:
+            return
+        records = self._columns()['records']
+        for index, column in ((self._by_camera, 'camera'), (self._by_class, 'result_class'), (self._by_band, 'band')):
+            values = np.asarray(records[column])
+            order = np.argsort(values, kind='stable')
+            keys, starts = np.unique(values[order], return_index=True)
+            for key, rows in zip(keys, np.split(order, starts[1:])):
+                index[int(key)] = array('q', rows.tolist())
+
+    def _columns(self):
+        """Memory maps over the committed rows, re-mapped when the store has grown."""
+        if self._maps is None or self._maps['size'] != self._size:
+            if self._size == 0:
+                return None
+            for f in (getattr(self, '_records_f', None), getattr(self, '_prepared_f', None),
+                      getattr(self, '_scores_f', None), getattr(self, '_blobs_f', None)):
+                if f is not None:
+                    f.flush()
+            self._maps = {
+                'size': self._size,
+                'records': np.memmap(self._fn(FN_RECORDS), dtype=RECORD_DTYPE, mode='r', shape=(self._size,)),
+                'prepared': np.memmap(self._fn(FN_PREPARED), dtype='u1', mode='r', shape=(self._size,) + IMAGE_SHAPE),
+                'scores': np.memmap(self._fn(FN_SCORES), dtype='<f4', mode='r', shape=(self._size, NUM_CLASSES)),
+            }
+        return self._maps
+
+    def __len__(self):
+        return self._size
+
+    def band_of(self, probability):
+        return int(np.searchsorted(self.bands, probability, side='right'))
+
+    def append(self, tup):
+        """Append a single 'UncertainPredictions' tuple (as a dict), returning its row number."""
+        with self._lock:
+            camera = tup['camera']
+            if camera not in self._camera_ids:
+                self._camera_ids[camera] = len(self.cameras)
+                self.cameras.append(camera)
+                with open(self._fn(FN_CAMERAS), 'w') as f:
+                    json.dump(self.cameras, f)
+
+            blob = base64.b64decode(tup['image'])
+            blob_offset = self._blobs_f.tell()
+            self._blobs_f.write(blob)
+            self._prepared_f.write(np.asarray(tup['prepared_image'], dtype='u1').reshape(IMAGE_SHAPE).tobytes())
+            self._scores_f.write(np.asarray(tup['predictions'], dtype='<f4').reshape(NUM_CLASSES).tobytes())
+
+            record = np.zeros(1, dtype=RECORD_DTYPE)
+            record['timestamp'] = parse_timestamp(tup['timestamp'])
+            record['count'] = tup.get('count', -1)
+            record['blob_offset'] = blob_offset
+            record['blob_length'] = len(blob)
+            record['camera'] = self._camera_ids[camera]
+            record['result_probability'] = tup['result_probability']
+            record['result_class'] = tup['result_class']
+            record['band'] = self.band_of(tup['result_probability'])
+            self._records_f.write(record.tobytes())
+
+            row = self._size
+            self._size += 1
+            self._by_camera.setdefault(int(record['camera'][0]), array('q')).append(row)
+            self._by_class.setdefault(int(record['result_class'][0]), array('q')).append(row)
+            self._by_band.setdefault(int(record['band'][0]), array('q')).append(row)
+            self._time_order = None
+            return row
+
+    def extend(self, tuples):
+        for tup in tuples:
+            self.append(tup)
+
+    def flush(self):
+        with self._lock:
+            for f in (self._blobs_f, self._prepared_f, self._scores_f, self._records_f):
+                f.flush()
+
+    def close(self):
+        with self._lock:
+            self._maps = None
+            for f in (self._blobs_f, self._prepared_f, self._scores_f, self._records_f):
+                f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def select(self, camera=None, result_class=None, band=None, since=None, until=None):
+        """Row numbers matching all the given criteria, in arrival order.
+
+        Args:
+            camera: camera name.
+            result_class: predicted digit.
+            band: confidence band number (see band_of()).
+            since, until: time range, as ISO timestamps or seconds since the epoch (until is exclusive).
+        """
+        with self._lock:
+            if self._size == 0:
+                return np.empty(0, dtype='i8')
+            rows = None
+            for index, key in ((self._by_camera, self._camera_ids.get(camera, -1) if camera is not None else None),
+                               (self._by_class, result_class),
+                               (self._by_band, band)):
+                if key is None:
+                    continue
+                postings = np.frombuffer(index.get(key, array('q')), dtype='i8')
+                rows = postings if rows is None else np.intersect1d(rows, postings, assume_unique=True)
+            if since is not None or until is not None:
+                in_range = self._time_range(since, until)
+                rows = in_range if rows is None else np.intersect1d(rows, in_range, assume_unique=True)
+            return np.arange(self._size, dtype='i8') if rows is None else rows
+
+    def _time_range(self, since, until):
+        records = self._columns()['records']
+        if self._time_order is None:
+            self._time_order = np.argsort(records['timestamp'], kind='stable')
+        ordered = records['timestamp'][self._time_order]
+        lo = 0 if since is None else np.searchsorted(ordered, since if not isinstance(since, str) else parse_timestamp(since), side='left')
+        hi = len(ordered) if until is None else np.searchsorted(ordered, until if not isinstance(until, str) else parse_timestamp(until), side='left')
+        return np.sort(self._time_order[lo:hi])
+
+    def count(self, **criteria):
+        return len(self.select(**criteria))
+
+    def get(self, row):
+        """Rebuild the 'UncertainPredictions' tuple stored at the given row."""
+        with self._lock:
+            maps = self._columns()
+            record = maps['records'][row]
+            self._blobs_f.flush()
+            with open(self._fn(FN_BLOBS), 'rb') as f:
+                f.seek(int(record['blob_offset']))
+                blob = f.read(int(record['blob_length']))
+            return {'camera': self.cameras[int(record['camera'])],
+                    'count': int(record['count']),
+                    'timestamp': format_timestamp(record['timestamp']),
+                    'result_class': int(record['result_class']),
+                    'result_probability': float(record['result_probability']),
+                    'predictions': maps['scores'][row].tolist(),
+                    'prepared_image': maps['prepared'][row].tolist(),
+                    'image': base64.b64encode(blob).decode('utf-8'),
+                    'row': int(row)}
+
+    def query(self, offset=0, limit=20, newest_first=True, **criteria):
+        """One page of matching tuples.
+
+        Returns:
+            (tuples, total) where total is the number of matches over all pages.
+        """
+        rows = self.select(**criteria)
+        if newest_first:
+            rows = rows[::-1]
+        return [self.get(row) for row in rows[offset:offset + limit]], len(rows)
+
+    def pages(self, page_size=20, newest_first=True, **criteria):
+        """A lazily loaded sequence over the matches, suitable for the dashboards."""
+        return StorePage(self, self.select(**criteria)[::-1] if newest_first else self.select(**criteria), page_size)
+
+
+class StorePage(object):
+    """Read-only sequence of stored tuples, fetched one page at a time, for the dashboards.
+    extra, if given, holds a dict of fields per row to add to each tuple (e.g. duplicate_index clusters).
+    """
+    def __init__(self, store, rows, page_size=20, extra=None):
+        self.store = store
+        self.rows = rows
+        self.page_size = page_size
+        self.extra = extra
+        self._page_start = None
+        self._page = None
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self[i] for i in range(*idx.indices(len(self)))]
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError(idx)
+        start = idx - idx % self.page_size
+        if start != self._page_start:
+            self._page = [self.store.get(row) for row in self.rows[start:start + self.page_size]]
+            if self.extra is not None:
+                for tup, extra in zip(self._page, self.extra[start:start + self.page_size]):
+                    tup.update(extra)
+            self._page_start = start
+        return self._page[idx - start]
+
+    def __iter__(self):
+        for idx in range(len(self)):
+            yield self[idx]
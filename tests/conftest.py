@@ -0,0 +1,23 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+DATA_ASSET_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'assets', 'data_asset')
+
+# The data_asset modules import each other by name, as they do in the notebooks
+if DATA_ASSET_DIR not in sys.path:
+    sys.path.insert(0, DATA_ASSET_DIR)
+
+
+@pytest.fixture
+def data_asset_dir():
+    return DATA_ASSET_DIR
+
+
+# A small stand-in for an mnist_index_files.IdxReader of 28x28 images
+@pytest.fixture
+def mnist_units():
+    rng = np.random.RandomState(0)
+    return [rng.randint(0, 256, size=(28, 28)).astype(np.uint8) for i in range(10)]
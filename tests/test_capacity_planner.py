@@ -0,0 +1,25 @@
+import capacity_planner
+
+
+def metrics_message(scored, shed, delay=0.01, frame_skip=0, parallelism=1, duration=10, prep=0.001, predict=0.002):
+    return {'camera_metrics': {'Camera-vm': {'certain': [scored] + [0] * 10, 'uncertain': [0] * 11, 'shed': shed}},
+            'latency_metrics': {'prep': {'mean': prep}, 'predict': {'mean': predict}},
+            'config': {'delay': delay, 'frame_skip': frame_skip, 'classify_parallel': parallelism,
+                       'metrics_duration': duration}}
+
+
+def test_observation_counts_shed_images_as_submitted():
+    # One frame in two skipped at the source, and half of the rest shed in front of ImagePrep:
+    # 400 images left the source in 10s, each taking 2 * delay + prep + ti
+    obs = capacity_planner.observation(metrics_message(200, {'source': 400, 'dropped': 0, 'prep': 200, 'predict': 0},
+                                                       frame_skip=1))
+    assert obs['rate'] == 20.0
+    assert obs['offered_rate'] == 40.0
+    assert abs(obs['ti'] - (1 / 40.0 - 0.02 - 0.001)) < 1e-9
+
+
+def test_fit_with_frame_skip():
+    message = metrics_message(200, {'source': 400, 'dropped': 0, 'prep': 200, 'predict': 0}, frame_skip=1)
+    model = capacity_planner.ThroughputModel.fit([capacity_planner.observation(message)] * 2)
+    assert abs(model.ti - 0.004) < 1e-9
+    assert abs(model.source_time(0.01, 1) - 1 / 40.0) < 1e-9
@@ -0,0 +1,42 @@
+import os
+import sys
+import inspect
+import subprocess
+
+import image_classifier
+
+
+# The data_asset modules the topology dependency resolver would bundle with a module: it
+# follows the module, class and function globals of each module it adds (see
+# streamsx.topology.dependency), which a lazy_import placeholder is not.
+def bundled_modules(module, data_asset_dir):
+    found = {}
+    pending = [module]
+    while pending:
+        module = pending.pop()
+        if module.__name__ in found:
+            continue
+        found[module.__name__] = module
+        for value in vars(module).values():
+            if inspect.ismodule(value):
+                dependency = value
+            elif inspect.isclass(value) or inspect.isroutine(value):
+                dependency = inspect.getmodule(value)
+            else:
+                continue
+            path = getattr(dependency, '__file__', None)
+            if path is not None and os.path.dirname(os.path.abspath(path)) == data_asset_dir:
+                pending.append(dependency)
+    return set(found)
+
+
+def test_image_classifier_bundles_local_modules(data_asset_dir):
+    assert {'image_classifier', 'lazy_import', 'operator_profiler', 'model_files', 'image_processing',
+            'digit_cascade', 'mnist_index_files'} <= bundled_modules(image_classifier, data_asset_dir)
+
+
+def test_image_classifier_defers_heavy_imports(data_asset_dir):
+    code = "import sys, image_classifier; print(sorted(m for m in ('PIL', 'joblib', 'streamsx') if m in sys.modules))"
+    result = subprocess.run([sys.executable, '-c', code], cwd=data_asset_dir,
+                            stdout=subprocess.PIPE, check=True, universal_newlines=True)
+    assert result.stdout.strip() == '[]'
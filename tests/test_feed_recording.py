@@ -0,0 +1,41 @@
+import feed_recording
+
+
+class ListSink(object):
+    def __init__(self):
+        self.messages = []
+
+    def publish(self, message, kind):
+        self.messages.append((message, kind))
+
+
+# Two partitions polled one after the other, as record_eventstreams records them
+def record_interleaved(path, start=1.5e9):
+    with feed_recording.FeedRecording(path) as recording:
+        for camera, offsets in (('cam-a', (0.0, 0.2, 0.4)), ('cam-b', (0.1, 0.3, 0.5))):
+            for offset in offsets:
+                recording.record({'camera': camera, 'offset': offset}, 'images', received_time=start + offset)
+    return feed_recording.FeedRecording(path)
+
+
+def test_rows_in_time_order(tmp_path):
+    recording = record_interleaved(str(tmp_path))
+    assert [recording.message(row)['offset'] for row in recording.rows()] == [0.0, 0.1, 0.2, 0.3, 0.4, 0.5]
+    assert abs(recording.describe()['duration'] - 0.5) < 1e-6
+
+
+def test_replay_in_time_order(tmp_path):
+    sink = ListSink()
+    result = feed_recording.FeedReplayer(record_interleaved(str(tmp_path)), sink, speed=10, retime=False).run()
+    assert [message['offset'] for message, kind in sink.messages] == [0.0, 0.1, 0.2, 0.3, 0.4, 0.5]
+    # The 0.5s recording, ten times faster
+    assert 0.045 <= result['elapsed'] < 0.5
+    assert result['max_lag'] < 0.05
+
+
+# Signed results of Kafka's Java Utils.murmur2
+def test_murmur2_matches_kafka():
+    expected = {'21': -973932308, 'foobar': -790332482, 'a-little-bit-long-string': -985981536,
+                'a-little-bit-longer-string': -1486304829, 'abc': 479470107}
+    for key, value in expected.items():
+        assert feed_recording.murmur2(key.encode('utf-8')) == value & 0xffffffff
@@ -0,0 +1,30 @@
+import time
+
+import pytest
+
+import image_source
+import image_classifier
+
+
+def test_more_cameras_than_images(mnist_units):
+    with pytest.raises(ValueError):
+        image_source.virtual_cameras(len(mnist_units) + 1, mnist_units, 0.0, 1)
+    assert len(image_source.virtual_cameras(len(mnist_units), mnist_units, 0.0, 1)) == len(mnist_units)
+
+
+def test_late_frames_are_counted_as_dropped(mnist_units):
+    camera = image_source.VirtualCamera('v0', mnist_units, interval=0.01)
+    cameras = image_source.VirtualCameras([camera])
+    # Five frame intervals late for the first frame
+    time.sleep(0.055)
+    t = next(cameras)
+    assert t['dropped'] >= 5
+    assert t['count'] == t['dropped']
+    # Every frame the count skips over is reported as dropped
+    following = next(cameras)
+    assert following['count'] == t['count'] + 1 + following.get('dropped', 0)
+
+    t.update({'camera': 'Camera-v0', 'timestamp': '2026-10-19T00:00:00Z'})
+    shed = image_classifier.shed_record(t, 'prep', 1.0)
+    metrics = image_classifier.compute_metrics([shed], 0.7, 10, 0.01, 1, 1, 0)
+    assert metrics['camera_metrics']['Camera-v0']['shed'] == {'source': 0, 'dropped': t['dropped'], 'prep': 1, 'predict': 0}